@@ -478,14 +478,20 @@ class FAT(object):
         to that amount."""
         if self.free_clusters_map == None:
             self.map_free_space()
-        try:
-            i, n = self.free_clusters_map.popitem()
-        except KeyError:
-            return -1, -1
+        # tries first the run following the last allocated cluster, if any
+        i = self.last_free_alloc+1
+        n = self.free_clusters_map.pop(i, 0)
+        if not n:
+            try:
+                i, n = self.free_clusters_map.popitem()
+            except KeyError:
+                self.last_free_alloc = 2 # disk full: forget the hint
+                return -1, -1
         if DEBUG&4: log("got run of %d free clusters from #%x", n, i)
         if n-count > 0:
             self.free_clusters_map[i+count] = n-count # updates map
         self.free_clusters-=min(n,count)
+        if count: self.last_free_alloc = i+min(n,count)-1
         return i, min(n, count)
     
     def map_compact(self, strategy=0):
@@ -1091,14 +1097,7 @@ class FATDirentry(Direntry):
 
     def pack(self):
         "Updates internal buffer"
-        s = b''
-        keys = list(self._kv.keys())
-        keys.sort()
-        for k in keys:
-            v = self._kv[k]
-            s += struct.pack(v[1], getattr(self, v[0]))
-        self._buf[-32:] = bytearray(s) # update always non-LFN part
-        return self._buf
+        return utils.pack(self) # update always non-LFN part (negative offsets)
 
     def __str__ (self):
         s = "FAT %sDirentry @%Xh\n" % ( ('','LFN ')[self.IsLfn()], self._pos )
@@ -1393,9 +1392,15 @@ class Dirtable(object):
 
     def wipefreespace(self):
         "Zeroes free clusters"
-        buf = (4<<20) * b'\x00'
+        buf = memoryview(bytearray(4<<20)) # slices without copying
         fourmegs = (4<<20)//self.boot.cluster
-        for start, length in self.fat.free_clusters_map.items():
+        runs = [] # free runs in disk order, adjacent ones merged
+        for start, length in sorted(self.fat.free_clusters_map.items()):
+            if runs and runs[-1][0]+runs[-1][1] == start:
+                runs[-1][1] += length
+            else:
+                runs += [[start, length]]
+        for start, length in runs:
             if DEBUG&4: log("Wiping %d clusters from cluster #%d", length, start)
             self.boot.stream.seek(self.boot.cl2offset(start))
             while length:
@@ -1726,6 +1731,74 @@ class Dirtable(object):
             buf = bytearray()
         self.stream.seek(told)
 
+    def iterator_batch(self, chunk=256):
+        """Iterates through directory table slots reading 'chunk' slots at a time
+        (or the whole table if 'chunk' is 0, i.e. one read per cluster run),
+        generating for each read a list of (name, isdir, size, mtime) tuples, one
+        per file or directory; mtime is a (year, month, day, hour, minute, second)
+        tuple. No FATDirentry is built, so it suits fast listings only."""
+        unpack = struct.Struct('<HH2xI').unpack_from # wMTime, wMDate, dwFileSize
+        def decode(name, s, i):
+            wTime, wDate, size = unpack(s, i+0x16)
+            return (name, s[i+0x0B] & 0x10 == 0x10, size,
+            ((wDate>>9)+1980, (wDate>>5)&0xF, wDate&0x1F, wTime>>11, (wTime>>5)&0x3F, wTime&0x1F))
+        return self._walk_batch(chunk, decode)
+
+    def scandir(self):
+        """Returns a list of (name, attributes, start cluster, size) tuples, one per
+        slot set in disk order (volume label included), reading the whole table at
+        once: it tells names and types apart without building FATDirentry objects"""
+        return [r for batch in self.scandir_batch(0) for r in batch]
+
+    def scandir_batch(self, chunk=256):
+        """Like scandir, but reads 'chunk' slots at a time (the whole table if 0),
+        generating a list of tuples for each read"""
+        unpack = struct.Struct('<H4xHI').unpack_from # wClusterHi, wClusterLo, dwFileSize
+        def decode(name, s, i):
+            hi, lo, size = unpack(s, i+0x14)
+            return (name, s[i+0x0B], (hi<<16) | lo, size)
+        return self._walk_batch(chunk, decode, 1)
+
+    def _walk_batch(self, chunk, decode, labels=0):
+        """Walks the table slots for iterator_batch and scandir, generating for
+        each read the list of decode(name, slots, offset) results, where offset
+        points to the short slot of each name in slots"""
+        self._checkopen()
+        told = self.stream.tell()
+        lfn = [] # UTF-16 chars of pending LFN slots
+        shortname = FATDirentry.GetShortName
+        pos = 0
+        end = 0
+        while not end:
+            self.stream.seek(pos)
+            s = self.stream.read((-1, chunk*32)[chunk > 0])
+            if not s: break
+            pos += len(s)
+            L = []
+            for i in range(0, len(s), 32):
+                c = s[i]
+                if not c:
+                    end = 1
+                    break
+                if c == 0xE5: continue
+                attr = s[i+0x0B]
+                if attr == 0x0F and s[i+0x0C] == s[i+0x1A] == s[i+0x1B] == 0: # LFN
+                    lfn += [s[i+1:i+11] + s[i+14:i+26] + s[i+28:i+32]]
+                    continue
+                name = ''
+                if lfn:
+                    lfn.reverse()
+                    name = b''.join(lfn).decode('utf-16le')
+                    j = name.find('\x00') # ending NULL may be omitted!
+                    if j > -1: name = name[:j]
+                    lfn = []
+                elif attr == 0x08 and not labels: continue # volume label
+                if not name:
+                    name = shortname(s[i:i+11], s[i+0x0C])
+                L += [decode(name, s, i)]
+            if L: yield L
+        self.stream.seek(told)
+
     def _update_dirtable(self, it, erase=False):
         "Updates internal cache of object names and their associated slots"
         if DEBUG&4:
@@ -200,6 +200,8 @@ def openvolume(part):
         return 'EINV'
 
     fat = FAT.FAT(part, boot.fatoffs, boot.clusters(), bitsize={'FAT12':12,'FAT16':16,'FAT32':32,'EXFAT':32}[fstyp], exfat=(fstyp=='EXFAT'))
+    if fstyp == 'FAT32' and boot.fsinfo and 2 < boot.fsinfo.dwNextFreeCluster <= fat.real_last:
+        fat.last_free_alloc = boot.fsinfo.dwNextFreeCluster-1 # restores the allocation hint
 
     if DEBUG&2:
         log("Inited BOOT object: %s", boot)
@@ -308,7 +310,7 @@ def copy_in(src_list, dest, callback=None, attributes=None, chunk_size=1<<20):
             fp = open(it, 'rb')
             # Create target, preallocating all clusters
             it = os.path.basename(it) # we want only file/dir name in target!
-            is_single_file = str(type(dest)).find('Handle') > -1
+            is_single_file = isinstance(dest, (FAT.Handle, exFAT.Handle))
             if is_single_file:
                 dst = dest
             else:
@@ -39,12 +39,25 @@ def crc_init(): return 0xffffffff
 
 def crc_finalize(crc): return crc ^ 0xffffffff
     
-def crc_update(crc, data, data_len):
-    "Updates CRC-32C for bytes in 'data'"
-    for i in range(data_len):
-        j = (crc ^ data[i]) & 0xff
-        crc = (crc_table[j] ^ (crc >> 8)) & 0xffffffff
-    return crc & 0xffffffff
+try:
+    # optional native backend, using the CPU CRC32 instructions where available
+    from google_crc32c import extend as _extend
+except ImportError:
+    _extend = None
+
+if _extend:
+    def crc_update(crc, data, data_len):
+        "Updates CRC-32C for bytes in 'data'"
+        # the backend works on finalized values
+        return _extend(crc ^ 0xffffffff, bytes(memoryview(data)[:data_len])) ^ 0xffffffff
+else:
+    def crc_update(crc, data, data_len):
+        "Updates CRC-32C for bytes in 'data'"
+        table = crc_table
+        crc &= 0xffffffff # stays 32-bit from now on
+        for b in memoryview(data)[:data_len]:
+            crc = table[(crc ^ b) & 0xff] ^ (crc >> 8)
+        return crc
 
 
 
@@ -315,15 +315,21 @@ class Bitmap(Chain):
         to that amount."""
         if self.free_clusters_map == None:
             self.map_free_space()
-        try:
-            i, n = self.free_clusters_map.popitem()
-        except KeyError:
-            return -1, -1
+        # tries first the run following the last allocated cluster, if any
+        i = self.last_free_alloc+1
+        n = self.free_clusters_map.pop(i, 0)
+        if not n:
+            try:
+                i, n = self.free_clusters_map.popitem()
+            except KeyError:
+                self.last_free_alloc = 2 # disk full: forget the hint
+                return -1, -1
         if DEBUG&8: log("Got run of %d free clusters from %d (%Xh)", n, i, i)
         if n-count > 0:
             self.free_clusters_map[i+count] = n-count # updates map
             if DEBUG&8: log("New free clusters map: %s", self.free_clusters_map)
         self.free_clusters-=min(n,count)
+        if count: self.last_free_alloc = i+min(n,count)-1
         return i, min(n, count)
 
     def findmaxrun(self, count=0):
@@ -650,8 +656,7 @@ class exFATDirentry(Direntry):
 
     def pack(self):
         "Update internal buffer"
-        for k, v in list(self._kv.items()):
-            self._buf[k:k+struct.calcsize(v[1])] = struct.pack(v[1], getattr(self, v[0]))
+        utils.pack(self)
         if self.type == 5:
             self.wChecksum = self.GetSetChecksum(self._buf) # update the slots set checksum
             self._buf[2:4] = struct.pack('<H', self.wChecksum)
@@ -840,9 +845,15 @@ class Dirtable(object):
 
     def wipefreespace(self):
         "Zeroes free clusters"
-        buf = (4<<20) * b'\x00'
+        buf = memoryview(bytearray(4<<20)) # slices without copying
         fourmegs = (4<<20)//self.boot.cluster
-        for start, length in self.boot.bitmap.free_clusters_map.items():
+        runs = [] # free runs in disk order, adjacent ones merged
+        for start, length in sorted(self.boot.bitmap.free_clusters_map.items()):
+            if runs and runs[-1][0]+runs[-1][1] == start:
+                runs[-1][1] += length
+            else:
+                runs += [[start, length]]
+        for start, length in runs:
             if DEBUG&4: log("Wiping %d clusters from cluster #%d", length, start)
             self.boot.stream.seek(self.boot.cl2offset(start))
             while length:
@@ -1160,6 +1171,70 @@ class Dirtable(object):
             count = 0
         self.stream.seek(told)
 
+    def iterator_batch(self, chunk=256):
+        """Iterates through directory table slots reading 'chunk' slots at a time
+        (or the whole table if 'chunk' is 0, i.e. one read per cluster run),
+        generating for each read a list of (name, isdir, size, mtime) tuples, one
+        per File Entry; mtime is a (year, month, day, hour, minute, second) tuple.
+        No exFATDirentry is built, so it suits fast listings only."""
+        def decode(name, buf):
+            wAttributes, dwMTime = struct.unpack_from('<H6xI', buf, 4) # dwMTime @0x0C
+            size = struct.unpack_from('<Q', buf, 0x38)[0]
+            wDate, wTime = dwMTime >> 16, dwMTime & 0xFFFF
+            return (name, wAttributes & 0x10 == 0x10, size,
+            ((wDate>>9)+1980, (wDate>>5)&0xF, wDate&0x1F, wTime>>11, (wTime>>5)&0x3F, wTime&0x1F))
+        return self._walk_batch(chunk, decode)
+
+    def scandir(self):
+        """Returns a list of (name, attributes, start cluster, size) tuples, one per
+        File Entry in disk order, reading the whole table at once: it tells names
+        and types apart without building exFATDirentry objects"""
+        return [r for batch in self.scandir_batch(0) for r in batch]
+
+    def scandir_batch(self, chunk=256):
+        """Like scandir, but reads 'chunk' slots at a time (the whole table if 0),
+        generating a list of tuples for each read"""
+        def decode(name, buf):
+            return (name, struct.unpack_from('<H', buf, 4)[0]) + struct.unpack_from('<IQ', buf, 0x34)
+        return self._walk_batch(chunk, decode)
+
+    def _walk_batch(self, chunk, decode):
+        """Walks the table slots for iterator_batch and scandir, generating for
+        each read the list of decode(name, slots) results, where slots is the
+        whole set of each File Entry"""
+        self._checkopen()
+        told = self.stream.tell()
+        buf = bytearray() # pending slots set
+        count = 0
+        pos = 0
+        end = 0
+        while not end:
+            self.stream.seek(pos)
+            s = self.stream.read((-1, chunk*32)[chunk > 0])
+            if not s: break
+            pos += len(s)
+            L = []
+            for i in range(0, len(s), 32):
+                if s[i] == 0:
+                    end = 1
+                    break
+                if s[i] & 0x80 != 0x80: continue # unused slot
+                if s[i] & 0x7F in (0x5, 0x20): # composite slot
+                    count = s[i+1] # slots to collect
+                    buf += s[i:i+32]
+                    continue
+                buf += s[i:i+32]
+                if count:
+                    count -= 1
+                    if count: continue
+                if buf[0] & 0x7F == 5: # File Entry
+                    name = b''.join([buf[j+2:j+32] for j in range(64, len(buf), 32)])
+                    L += [decode(name.decode('utf-16le')[:buf[0x23]], buf)]
+                buf = bytearray()
+                count = 0
+            if L: yield L
+        self.stream.seek(told)
+
     def _update_dirtable(self, it, erase=False):
         k = it.Name().lower()
         if erase:
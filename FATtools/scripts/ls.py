@@ -11,92 +11,105 @@ from FATtools.debug import log
 
 #~ logging.basicConfig(level=logging.DEBUG, filename='ls.log', filemode='w')
 
+_SUF = ('B', 'K', 'M', 'G', 'T', 'E') # size suffixes, by 10 bits steps
+_SCALE = tuple(1<<(10*i) for i in range(6)) # their scale factors
 
-def _ls(v, filt, opts, depth=0):
-    "Scans an opened DirHandle"
+
+def _scan(v):
+    "Collects the (name, isdir, size, mtime) tuples of an opened DirHandle"
+    return [r for batch in v.iterator_batch(0) for r in batch] # reads whole table
+
+def _ls(v, filt, opts, depth=0, rows=None):
+    "Scans an opened DirHandle (or its rows, if already collected)"
     def _fmt_size(size):
         "Internal function to format sizes"
         if size >= 10**12:
-            sizes = {0:'B', 10:'K',20:'M',30:'G',40:'T',50:'E'}
-            k = 0
-            for k in sorted(sizes):
-                if (size // (1<<k)) < 10**6: break
-            size = locale.format_string('%.02f%s', (size/(1<<k), sizes[k]), grouping=1)
+            # smallest scale leaving less than 10**6 units
+            i = min((size.bit_length()-11)//10, 5)
+            if i < 5 and size >= 10**6*_SCALE[i]: i += 1
+            size = '{:,.2f}'.format(size/_SCALE[i]).translate(opts.numconv) + _SUF[i]
         else:
-            size = locale.format_string('%d', size, grouping=1)
+            size = '{:,}'.format(size).translate(opts.numconv)
         return size
     def _prn_line(name, mtime, size):
         "Internal function to print a line of output"
-        print("%s  %16s  %s" % (mtime.isoformat()[:-3].replace('T','  '), size, name))
+        emit("%s  %16s  %s\n" % (mtime.isoformat()[:-3].replace('T','  '), size, name))
 
-    isexfat = 'exFAT' in str(type(v))
-
-    if not opts.bare: print("\n Directory of %s\n"%v.path)
+    out = [] # output lines, written once per directory
+    emit = out.append
+    if not opts.bare: emit("\n Directory of %s\n\n"%v.path)
     tot_files = 0
     tot_bytes = 0
     tot_dirs = 0
     table = [] # used to sort
+    if opts.sort:
+        sortkey = itemgetter(*opts.sort)
+        needs_ext, needs_lower = 4 in opts.sort, 5 in opts.sort # fields to compute
     dirs = [] # directories to traverse in recursive mode
-    for it in v.iterator():
-        if isexfat:
-            if it.type != 5: continue
-        else:
-            if it.IsLabel(): continue
-        if filt:
-            if not fnmatch.fnmatch(it.Name(), filt):
+    def _open(d):
+        "Internal function to open and collect a subdirectory"
+        vd = v.opendir(d)
+        return vd, _scan(vd)
+    if rows is None: rows = _scan(v)
+    if opts.bare and not opts.sort: # names only: no dates, sizes or totals
+        prefix = os.path.join(v.path, '') # joined once per directory
+        for nm, isdir, size, mtime in rows:
+            if filt and not fnmatch.fnmatch(nm, filt): continue
+            if not opts.recursive:
+                emit(nm+'\n')
                 continue
-        if opts.recursive and it.IsDir():
-            name = it.Name()
-            dirs += [name]
-        if opts.bare and not opts.sort:
-            if opts.recursive:
-                print (os.path.join(v.path, it.Name()))
-            else:
-                print(it.Name())
-        else:
-            if isexfat:
-                tot_bytes += it.u64DataLength
-            else:
-                tot_bytes += it.dwFileSize
-            if it.IsDir(): tot_dirs += 1
-            else: tot_files += 1
-            if isexfat:
-                mtime = datetime(*(it.DatetimeParse(it.dwMTime)))
-                size = it.u64DataLength
-            else:
-                mtime = datetime(*(it.ParseDosDate(it.wMDate) + it.ParseDosTime(it.wMTime)))
-                size = it.dwFileSize
-            if opts.sort:
-                name = it.Name()
-                # 0=Name, 1=DIR?, 2=Size, 3=Date, 4=Ext, 5=name
-                table += [(name, not it.IsDir(), size, mtime, os.path.splitext(name)[1].lower(), name.lower())]
+            if isdir and nm != '.' and nm != '..':
+                dirs += [nm]
+            emit(prefix+nm+'\n')
+        rows = () # all done
+    for nm, isdir, size, mtime in rows:
+        mtime = datetime(*mtime)
+        if filt:
+            if not fnmatch.fnmatch(nm, filt):
                 continue
-            _prn_line(it.Name(), mtime, (_fmt_size(size),'<DIR>   ')[it.IsDir()])
+        if opts.recursive and isdir and nm != '.' and nm != '..':
+            dirs += [nm]
+        tot_bytes += size
+        if isdir: tot_dirs += 1
+        else: tot_files += 1
+        if opts.sort:
+            # key fields: 0=Name, 1=DIR?, 2=Size, 3=Date, 4=Ext, 5=name
+            # names are unique in a directory, so the key is total
+            key = sortkey((nm, not isdir, size, mtime,
+            (os.path.splitext(nm)[1].lower() if needs_ext else ''), (nm.lower() if needs_lower else '')))
+            table += [(key, nm, mtime, size, isdir)]
+            continue
+        _prn_line(nm, mtime, (_fmt_size(size),'<DIR>   ')[isdir])
     if opts.sort:
-        for it in sorted(table, key=itemgetter(*opts.sort), reverse=opts.sort_reverse):
+        for it in sorted(table, key=itemgetter(0), reverse=opts.sort_reverse):
             if opts.bare:
-                print(it[0])
+                emit(it[1]+'\n')
             else:
-                _prn_line(it[0], it[3], (_fmt_size(it[2]),'<DIR>   ')[not it[1]])
+                _prn_line(it[1], it[2], (_fmt_size(it[3]),'<DIR>   ')[it[4]])
     if not opts.bare:
-        print("%18s Files    %s bytes" % (_fmt_size(tot_files), _fmt_size(tot_bytes)))
+        emit("%18s Files    %s bytes\n" % (_fmt_size(tot_files), _fmt_size(tot_bytes)))
+    sys.stdout.writelines(out)
+    del out[:]
     if opts.recursive:
         for d in dirs:
-            if d == '.' or d == '..': continue
-            ff, dd, bb = _ls(v.opendir(d), filt, opts, depth+1)
+            vd, rows = _open(d)
+            ff, dd, bb = _ls(vd, filt, opts, depth+1, rows)
             tot_files += ff
             tot_dirs += dd
             tot_bytes += bb
     if not opts.bare and not depth:
         if opts.recursive:
-            print ("\n     Total items listed:")
-            print("%18s Files    %s bytes" % (_fmt_size(tot_files), _fmt_size(tot_bytes)))
-        print("%18s Directories %12s bytes free" % (_fmt_size(tot_dirs), _fmt_size(v.getdiskspace()[1])))
+            emit("\n     Total items listed:\n")
+            emit("%18s Files    %s bytes\n" % (_fmt_size(tot_files), _fmt_size(tot_bytes)))
+        emit("%18s Directories %12s bytes free\n" % (_fmt_size(tot_dirs), _fmt_size(v.getdiskspace()[1])))
+        sys.stdout.writelines(out)
     return tot_files, tot_dirs, tot_bytes
 
     
 def ls(args, opts):
     "Simple, DOS style directory listing, with size and last modification time"
+    conv = locale.localeconv() # read once: the locale could be set after import
+    opts.numconv = str.maketrans({',': conv['thousands_sep'], '.': conv['decimal_point']})
     for arg in args:
         filt = None # wildcard filter
         img = is_vdisk(arg) # object to open
@@ -106,10 +119,7 @@ def ls(args, opts):
         # wildcard? expand src list with matching items
         if '*' in path or '?' in path:
             # wildcard MUST be in the normalized path last component 
-            path = os.path.normpath(path)
-            L = path.split(os.sep)
-            filt = L.pop() # assumes jolly here
-            path = os.sep.join(L) # rebuilds path part
+            path, sep, filt = os.path.normpath(path).rpartition(os.sep) # assumes jolly in filt
         if path:
             v = v.opendir(path)
         if not v:
@@ -150,19 +160,14 @@ def call(args):
     opts.sort_dirfirst = 0
     
     if args.sort:
-        opts.sort = []
-        for c in args.sort:
-            if  c == '-':
-                opts.sort_reverse = 1
-                continue
-            if c == '!':
-                opts.sort_dirfirst = 1
-                continue
-            if c not in 'NSDE':
-                print("ls error: unknown sort method specified '%s'!"%c)
-                par.print_help()
-                sys.exit(1)
-            opts.sort += [{'N':5,'S':2,'D':3,'E':4}[c]]
+        bad = [c for c in args.sort if c not in 'NSDE-!']
+        if bad:
+            print("ls error: unknown sort method specified '%s'!"%bad[0])
+            par.print_help()
+            sys.exit(1)
+        opts.sort_reverse = int('-' in args.sort)
+        opts.sort_dirfirst = int('!' in args.sort)
+        opts.sort = [{'N':5,'S':2,'D':3,'E':4}[c] for c in args.sort if c != '-' and c != '!']
         if opts.sort_dirfirst:
             opts.sort.insert(0, 1)
         opts.sort = tuple(opts.sort)
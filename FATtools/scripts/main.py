@@ -15,9 +15,10 @@ def main():
     
     par=argparse.ArgumentParser(usage=help_s)
     subparsers=par.add_subparsers(help="command to perform")
-    for x in scripts:
-        mod=importlib.import_module("FATtools.scripts.%s"%x)
-        subpar=mod.create_parser(subparsers.add_parser,[x])
-        subpar.set_defaults(func=mod.call)
+    # imports the selected command only
+    x=sys.argv[1]
+    mod=importlib.import_module("FATtools.scripts.%s"%x)
+    subpar=mod.create_parser(subparsers.add_parser,[x])
+    subpar.set_defaults(func=mod.call)
     args=par.parse_args()
     args.func(args)
@@ -1,10 +1,8 @@
-import struct, os, sys, pprint, math, importlib, locale
+import sys
 import argparse
-from FATtools import utils, partutils
-from FATtools.FAT import *
-from FATtools.exFAT import *
+from FATtools import partutils
 from FATtools.Volume import vopen
-from FATtools.mkfat import *
+from FATtools.mkfat import fat_mkfs, exfat_mkfs
 
 
 def create_parser(parser_create_fn=argparse.ArgumentParser,parser_create_args=None):
@@ -5,7 +5,7 @@ Visually alters a FAT/FAT32 directory table order.
 Very useful with micro Hi-Fi supporting USB keys but low of memory and bad
 in browsing."""
 
-import sys, os, argparse
+import sys, os, argparse, threading, queue
 
 if sys.version_info >= (3,0): 
     from tkinter import *
@@ -33,7 +33,10 @@ class ReorderableListbox(Listbox):
         self.bind('<B1-Motion>', self.shiftSelection)
         self.bind('<Leave>',  self.onLeave)
         self.bind('<Enter>',  self.onEnter)
+        self.bind('<ButtonRelease-1>', self.endDrag)
         self.selectionClicked = False
+        self.lineHeight = 0 # line and widget heights, queried once per drag
+        self.dragHeight = 0
         self.left = False
         self.unlockShifting()
         self.ctrlClicked = False
@@ -61,12 +64,20 @@ class ReorderableListbox(Listbox):
     def toggleSelection(self, event):
         self.ctrlClicked = True
 
+    def endDrag(self, event):
+        self.dragHeight = 0
+
     def moveElement(self, source, target):
         if not self.ctrlClicked:
             element = self.get(source)
             self.delete(source)
             self.insert(target, element)
 
+    def replaceLines(self, first, last, lines):
+        # one delete and insert pair, whatever the lines moved
+        self.delete(first, last)
+        self.insert(first, *lines)
+
     def unlockShifting(self):
         self.shifting = False
 
@@ -83,14 +94,19 @@ class ReorderableListbox(Listbox):
         if not self.selectionClicked or len(selection) == 0:
             return
 
+        selected = set(selection) # tested without asking Tcl item by item
         selectionRange = range(min(selection), max(selection))
         currentIndex = self.nearest(event.y)
 
         if self.shifting:
             return 'break'
 
-        lineHeight = 15
-        bottomY = self.winfo_height()
+        if not self.dragHeight:
+            bbox = self.bbox(self.nearest(0)) # first visible line
+            self.lineHeight = bbox[3] if bbox else 15
+            self.dragHeight = self.winfo_height()
+        lineHeight = self.lineHeight
+        bottomY = self.dragHeight
         if event.y >= bottomY - lineHeight:
             self.lockShifting()
             self.see(self.nearest(bottomY - lineHeight) + 1)
@@ -102,23 +118,23 @@ class ReorderableListbox(Listbox):
 
         if currentIndex < min(selection):
             self.lockShifting()
-            notInSelectionIndex = 0
-            for i in selectionRange[::-1]:
-                if not self.selection_includes(i):
-                    self.moveElement(i, max(selection)-notInSelectionIndex)
-                    notInSelectionIndex += 1
-            currentIndex = min(selection)-1
-            self.moveElement(currentIndex, currentIndex + len(selection))
+            first, last = min(selection)-1, max(selection)
+            lines = self.get(first, last)
+            # selected lines go up, followed by the one above them and the unselected ones
+            lines = [lines[i-first] for i in selection] + [lines[0]] + \
+            [lines[i-first] for i in selectionRange if i not in selected]
+            self.replaceLines(first, last, lines)
+            self.selection_set(first, first+len(selection)-1)
             self.orderChangedEventHandler()
         elif currentIndex > max(selection):
             self.lockShifting()
-            notInSelectionIndex = 0
-            for i in selectionRange:
-                if not self.selection_includes(i):
-                    self.moveElement(i, min(selection)+notInSelectionIndex)
-                    notInSelectionIndex += 1
-            currentIndex = max(selection)+1
-            self.moveElement(currentIndex, currentIndex - len(selection))
+            first, last = min(selection), max(selection)+1
+            lines = self.get(first, last)
+            # unselected lines and the one below the selected ones go up
+            lines = [lines[i-first] for i in selectionRange if i not in selected] + \
+            [lines[-1]] + [lines[i-first] for i in selection]
+            self.replaceLines(first, last, lines)
+            self.selection_set(last-len(selection)+1, last)
             self.orderChangedEventHandler()
         self.unlockShifting()
         return 'break'
@@ -130,6 +146,8 @@ class Manipulator(Tk):
         Tk.__init__(p)
         p.disk = '' # stores the device/image to open
         p.root = None # opened root Dirtable
+        p._scan_queue = None # name batches read by the scan in progress
+        p._scan_thread = None # thread reading the scanned directory
         p.title("Reorder a FAT/FAT32 directory table")
         p.geometry('640x510')
         frame = Frame(p, width=640, height=480)
@@ -191,28 +209,42 @@ class Manipulator(Tk):
                 p.path_to_sort.set('')
         p.scan_button.invoke() # but we don't know if it is a directory...
 
+    def _reorder(p, items, marks):
+        "Replaces the list box contents with 'items', selecting the marked ones"
+        top = p.list.yview()[0]
+        p.list.delete(0, END)
+        p.list.insert(0, *items)
+        for i in range(len(marks)):
+            if marks[i]: p.list.selection_set(i)
+        p.list.yview_moveto(top)
+
+    def _move(p, sel, step):
+        "Moves the selected items one place up (step=-1) or down (step=1)"
+        items = list(p.list.get(0, END))
+        marks = [0]*len(items)
+        for i in sel: marks[i] = 1
+        for i in sel:
+            j = i+step
+            if j < 0 or j >= len(items) or marks[j]: continue # blocked
+            items[i], items[j] = items[j], items[i]
+            marks[i], marks[j] = marks[j], marks[i]
+        p._reorder(items, marks)
+
     def move_up(p):
-        for i in p.list.curselection():
-            it = p.list.get(i)
-            p.list.delete(i)
-            p.list.insert(i-1, it)
-            p.list.selection_set(i-1)
+        p._move(p.list.curselection(), -1)
 
     def move_down(p):
-        for i in p.list.curselection():
-            it = p.list.get(i)
-            p.list.delete(i)
-            p.list.insert(i+1, it)
-            p.list.selection_set(i+1)
+        p._move(p.list.curselection()[::-1], 1)
             
     def move_top(p):
         sel = p.list.curselection()
-        for i, j in zip(range(len(sel)), sel):
-            it = p.list.get(j)
-            p.list.delete(j)
-            p.list.insert(i, it)
+        items = list(p.list.get(0, END))
+        chosen = set(sel)
+        items = [items[j] for j in sel] + [items[i] for i in range(len(items)) if i not in chosen]
+        p._reorder(items, [1]*len(sel))
             
     def scan(p):
+        p._stop_scan()
         root = p.tbox1.get()
         if not root: return
         if DEBUG:
@@ -245,10 +277,54 @@ class Manipulator(Tk):
         if DEBUG:
             print ("DEBUG: scanning", fold.path)
         p.list.delete(0, END)
-        for it in p.fold.iterator():
-            p.list.insert(END, it.Name())
+        # the table is read in background, while the GUI shows what was read
+        q = p._scan_queue = queue.Queue()
+        p._scan_thread = threading.Thread(target=p._read, args=(p.fold, q))
+        p._scan_thread.daemon = True
+        p._scan_thread.start()
+        p._pump(q)
+
+    def _read(p, fold, q):
+        "Queues the names of a directory table, 500 at a time (None ends)"
+        try:
+            for L in fold.scandir_batch(500):
+                if q is not p._scan_queue: break # scan cancelled
+                q.put([it[0] for it in L])
+        finally:
+            q.put(None)
+
+    def _stop_scan(p):
+        "Cancels a scan in progress, waiting for its disk reads to end"
+        p._scan_queue = None
+        if p._scan_thread:
+            p._scan_thread.join()
+            p._scan_thread = None
+
+    def _pump(p, q, wait=False):
+        "Shows the names read so far, then polls again (or waits for all of them)"
+        if q is not p._scan_queue: return # scan cancelled or done
+        names = []
+        try:
+            while 1:
+                L = q.get(wait)
+                if L is None:
+                    p._scan_queue = None
+                    break
+                names += L
+        except queue.Empty:
+            pass
+        # detaches the scrollbar while filling, then inserts all names at once
+        if names:
+            yscroll = p.list.cget('yscrollcommand')
+            p.list.config(yscrollcommand='')
+            p.list.insert(END, *names)
+            p.list.config(yscrollcommand=yscroll)
+        if p._scan_queue:
+            p.after(20, p._pump, q)
 
     def apply(p):
+        if p._scan_queue: # the whole table must be listed
+            p._pump(p._scan_queue, True)
         li = p.list.get(0, END)
         if not li: return
         if DEBUG:
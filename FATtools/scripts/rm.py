@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
-import sys, os, argparse, logging, fnmatch
+import sys, os, re, argparse, logging, fnmatch
+from operator import itemgetter
 from FATtools import Volume
 from FATtools.utils import myfile, is_vdisk
 
@@ -32,6 +33,18 @@ def _rm(v, args):
             r = v.rmtree(it)
             if DEBUG&2: log("rm: rmtree('%s') returned %d", it, r)
 
+def _rm_found(v, items):
+    "Removes the (name, attributes, start, size) items scanned in an opened DirHandle"
+    # frees the chains in disk order, so the FAT is walked forward once
+    for it, attr, start, size in sorted(items, key=itemgetter(2)):
+        if attr & 0x10:
+            print("Erasing directory %s..." % it)
+            r = v.rmtree(it)
+            if DEBUG&2: log("rm: rmtree('%s') returned %d", it, r)
+        else:
+            print("Erasing file %s" % it)
+            r = v.erase(it)
+            if DEBUG&2: log("rm: erase('%s') returned %d", it, r)
 
 
 def rm(args):
@@ -44,24 +57,22 @@ def rm(args):
         # wildcard? expand src list with matching items
         if '*' in path or '?' in path:
             # wildcard MUST be in the normalized path last component 
-            path = os.path.normpath(path)
-            L = path.split(os.sep)
-            filt = L.pop() # assumes jolly here
-            path = os.sep.join(L) # rebuilds path part
+            path, sep, filt = os.path.normpath(path).rpartition(os.sep) # assumes jolly in filt
             if path:
                 v = v.opendir(path)
         if not v:
             print('Invalid path: "%s"'%arg)
             continue
         if filt:
-            todo=[]
-            for it in v.listdir():
-                if fnmatch.fnmatch(it, filt):
-                    todo += [it]
+            # one table read tells names, types and first clusters; skips label and dot entries
+            todo = [it for it in v.scandir() if not it[1] & 0x08 and it[0] not in ('.', '..')]
+            if filt != '*':
+                match = re.compile(fnmatch.translate(os.path.normcase(filt))).match
+                todo = [it for it in todo if match(os.path.normcase(it[0]))]
             if not todo:
                 print('No matches for', filt)
             else:
-                _rm(v, todo)
+                _rm_found(v, todo)
         else:
             _rm(v, [path])
 
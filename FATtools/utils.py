@@ -1,5 +1,5 @@
 # -*- coding: cp1252 -*-
-import io, struct, os, re
+import io, struct, os, re, bisect, stat
 from FATtools.debug import log
 DEBUG=int(os.getenv('FATTOOLS_DEBUG', '0'))
 
@@ -7,78 +7,172 @@ class myfile(io.FileIO):
     "Wrapper for file object whose read member returns a bytearray"
     def __init__ (self, *args, **kwargs):
         super(myfile, self).__init__ (*args, **kwargs)
+        self._scratch = bytearray(512) # read_buf buffer
 
     def read(self, size=-1):
-        return bytearray(super(myfile, self).read(size))
+        if size is None or size < 0:
+            return bytearray(super(myfile, self).read())
+        if size > 1<<20: # only huge requests are capped to what a regular file holds
+            st = os.fstat(self.fileno())
+            if stat.S_ISREG(st.st_mode): size = max(0, min(size, st.st_size-self.tell()))
+        buf = bytearray(size) # reads in place, without copying from bytes
+        n = self.readinto(buf) or 0
+        if n < size: del buf[n:]
+        return buf
+
+    def read_buf(self, size):
+        """Reads up to 'size' bytes into an internal buffer, returning a memoryview
+        on them: it is valid until next read_buf call only"""
+        if len(self._scratch) < size: self._scratch = bytearray(size)
+        n = self.readinto(memoryview(self._scratch)[:size]) or 0
+        return memoryview(self._scratch)[:n]
+
+    if hasattr(os, 'pread'):
+        def pwrite(self, s, pos):
+            "Writes s at 'pos' without moving the file pointer"
+            return os.pwrite(self.fileno(), s, pos)
+
+        if hasattr(os, 'preadv'):
+            def preadinto(self, b, pos):
+                "Reads into buffer b at 'pos' without moving the file pointer, returning the bytes read"
+                return os.preadv(self.fileno(), [b], pos)
+        else:
+            def preadinto(self, b, pos):
+                "Reads into buffer b at 'pos' without moving the file pointer, returning the bytes read"
+                s = os.pread(self.fileno(), len(b), pos)
+                b[:len(s)] = s
+                return len(s)
+    else:
+        # i.e. Windows: positioned I/O through the file pointer, then restored
+        def preadinto(self, b, pos):
+            "Reads into buffer b at 'pos' without moving the file pointer, returning the bytes read"
+            opos = self.tell()
+            self.seek(pos)
+            n = self.readinto(b) or 0
+            self.seek(opos)
+            return n
+
+        def pwrite(self, s, pos):
+            "Writes s at 'pos' without moving the file pointer"
+            opos = self.tell()
+            self.seek(pos)
+            n = self.write(s)
+            self.seek(opos)
+            return n
+
+    def pread(self, size, pos):
+        "Reads up to 'size' bytes at 'pos' into a bytearray, without moving the file pointer"
+        if size > 1<<20: # like read
+            st = os.fstat(self.fileno())
+            if stat.S_ISREG(st.st_mode): size = max(0, min(size, st.st_size-pos))
+        buf = bytearray(size) # reads in place, like read
+        n = self.preadinto(buf, pos)
+        if n < size: del buf[n:]
+        return buf
+
+vdisk_re = re.compile(r'\.(vhdx?|vdi|vmdk|img|dsk|raw|bin)(?=$|[/\\])', re.IGNORECASE) # the extension ends the image name
 
 def is_vdisk(s):
     "Returns the base virtual disk image path if it contains a known extension or an empty string"
-    image_path=''
-    for ext in ('vhdx', 'vhd', 'vdi', 'vmdk', 'img', 'dsk', 'raw', 'bin'):
-        if '.'+ext in s.lower():
-            i = s.lower().find(ext)
-            image_path = s[:i+len(ext)]
-            break
-    return image_path
+    m = vdisk_re.search(s)
+    if not m: return ''
+    return s[:m.end()]
 
 def class2str(c, s):
     "Pretty-prints class contents"
-    keys = list(c._kv.keys())
-    keys.sort()
-    for key in keys:
+    for key in sorted(c._kv): # _kv may differ between instances of a class
         o = c._kv[key][0]
         v = getattr(c, o)
-        if type(v) in (type(0), type(0)):
+        if type(v) is int:
             v = hex(v)
         s += '%x: %s = %s\n' % (key, o, v)
     return s
 
+class _Structs(dict):
+    "Cache of compiled struct.Struct objects, keyed by format string"
+    def __missing__(self, fmt):
+        st = self[fmt] = struct.Struct(fmt)
+        return st
+
+structs = _Structs()
+
 def common_getattr(c, name):
     "Decodes and stores an attribute following special class layout"
     i = c._vk[name]
-    fmt = c._kv[i][1]
-    cnt = struct.unpack_from(fmt, c._buf, i+c._i) [0]
+    cnt = structs[c._kv[i][1]].unpack_from(c._buf, i+c._i) [0]
     setattr(c, name,  cnt)
     return cnt
 
-# Use hasattr to determine is value was previously unpacked, or avoid repacking?
 def pack(c):
-    "Updates internal buffer"
-    for k in list(c._kv.keys()):
-        v = c._kv[k]
-        c._buf[k:k+struct.calcsize(v[1])] = struct.pack(v[1], getattr(c, v[0]))
+    """Updates internal buffer with the attributes decoded or set since creation:
+    the others (never touched) are still the same in the buffer"""
+    d = c.__dict__
+    for k, v in c._kv.items():
+        if v[0] in d:
+            structs[v[1]].pack_into(c._buf, k+c._i, d[v[0]])
+    return c._buf
+
+def layout_runs(layout):
+    """Compiles a class layout into a list of (offset, struct.Struct, names), one
+    per run of adjacent fields with the same byte order"""
+    runs = []
+    end = -1
+    for k in sorted(layout):
+        name, fmt = layout[k]
+        order = fmt[0] if fmt[0] in '<>' else ''
+        if k != end or (order and runs[-1][3] and order != runs[-1][3]):
+            runs += [[k, '', [], order]]
+        run = runs[-1]
+        run[1] += fmt.lstrip('<>')
+        run[2] += [name]
+        if not run[3]: run[3] = order
+        end = k + struct.calcsize('<'+fmt.lstrip('<>'))
+    return [(k, struct.Struct((order or '<')+fmt), names) for k, fmt, names, order in runs]
+
+def compile_layout(cls):
+    """Compiles the fixed layout of a class once: its runs and the offset/name
+    maps are shared by all instances"""
+    cls._runs = layout_runs(cls.layout)
+    cls._kv = cls.layout
+    cls._vk = {v[0]: k for k, v in cls.layout.items()} # { name: offset}
+    return cls
+
+def unpack_runs(c, runs):
+    "Decodes and stores all the attributes, unpacking each run in one call"
+    d = c.__dict__
+    for k, st, names in runs:
+        d.update(zip(names, st.unpack_from(c._buf, k+c._i)))
+
+def pack_runs(c, runs):
+    "Updates internal buffer with all the attributes, packing each run in one call"
+    for k, st, names in runs:
+        st.pack_into(c._buf, k+c._i, *[getattr(c, n) for n in names])
     return c._buf
 
 def common_setattr(c, name, value):
     "Imposta e codifica un attributo in base al layout di classe"
     object.__setattr__(c, name,  value)
     i = c._vk[name]
-    fmt = c._kv[i][1]
-    struct.pack_into(fmt, c._buf, i+c._i, value)
+    structs[c._kv[i][1]].pack_into(c._buf, i+c._i, value)
 
 def FSguess(boot):
     "Try to guess the file system type between FAT12/16/32, exFAT and NTFS examining the boot sector"
-    # if no signature or JMP opcode, it is not valid
-    #~ print boot._buf[0], ord(boot._buf[0]), hex(ord(boot._buf[0]))
-    if boot.wBootSignature != 0xAA55 or boot._buf[0] not in ('\xEB', 0xEB, '\xE9', 0xE9):
+    # if no signature or JMP opcode, it is not valid: checked first, on integers only
+    if boot.wBootSignature != 0xAA55 or boot._buf[0] not in (0xEB, 0xE9):
         return 'NONE'
-    if boot.chOemID.startswith(b'NTFS'):
+    if boot.chOemID[:4] == b'NTFS':
         return 'NTFS'
     if boot.wBytesPerSector == 0:
         return 'EXFAT'
     if boot.wMaxRootEntries == 0:
         return 'FAT32'
-    if boot.sFSType.rstrip() in ('FAT12', 'FAT16'):
-        return boot.sFSType.rstrip().decode()
+    # sFSType is only a label and formatters often set it wrong: geometry decides
     if boot.wMaxRootEntries < 512:
         return 'FAT12'
     return 'FAT16'
 
-def get_format_parameters(size, id=None, sector=512):
-    "Returns the format parameters for a given floppy size or type"
-    # { id: {total_sectors, media_byte, sector_size, cluster_size, root_entries} }
-    sectors = size//sector
-    params = {
+# { id: {total_sectors, media_byte, sector_size, cluster_size, root_entries} }
+_FLOPPY_PARAMS = {
     "fd160": {"total_sectors":320, "media_byte":0xFE, "cluster_size":512, "root_entries":64}, # 5.25" SS/DD 160KB
     "fd180": {"total_sectors":360, "media_byte":0xFC, "cluster_size":512, "root_entries":64}, # 5.25" SS/DD 180KB
     "fd320": {"total_sectors":640, "media_byte":0xFF, "cluster_size":1024, "root_entries":112}, # 5.25" DS/DD 320KB
@@ -92,15 +186,20 @@ def get_format_parameters(size, id=None, sector=512):
    "fd1722": {"total_sectors":3444,"media_byte":0xF0, "cluster_size":512, "root_entries":224}, # 3.5" DS/HD 1720KB
    "fd1840": {"total_sectors":3680,"media_byte":0xF0, "cluster_size":512, "root_entries":224}, # 3.5" DS/HD 1840KB (IBM XDF)
    "fd2880": {"total_sectors":5760,"media_byte":0xF0, "cluster_size":1024, "root_entries":240}, # 3.5" DS/ED 2880KB
-    }
-    ret = None
+}
+# {total_sectors: params} index: the first id listed wins a tie (i.e. msmdf1)
+_FLOPPY_BY_SECTORS = {v["total_sectors"]: v for v in reversed(list(_FLOPPY_PARAMS.values()))}
+
+def get_format_parameters(size, id=None, sector=512):
+    "Returns the format parameters for a given floppy size or type"
     if id:
-        ret = params.get(id)
+        ret = _FLOPPY_PARAMS.get(id)
         if ret: return ret
-    for k, v in params.items():
-        if v["total_sectors"] == sectors: return v
-    return None
+    return _FLOPPY_BY_SECTORS.get(size//sector)
     
+_HEADS = (2,4,6,8,9,10,16,32,64,128,240,255) # heads
+_HEADS_LIMIT = tuple(1025*h for h in _HEADS) # sectors//63 below which they fit 1024 cylinders
+
 def get_geometry(size, sector=512):
     "Returns the CHS geometry that fits a disk size"
     # Heads and Sectors Per track are always needed in a FAT boot sector.
@@ -136,18 +235,12 @@ def get_geometry(size, sector=512):
     # Calculates the number of full cylinders that fits the given size
     # Please note: Windows 11 uses X-255-63 geometry even for a 20 MiB drive!
     # DOS approach is more conservative
-    for s in (17,36,48,52,63): # sectors per cylinder
-        ch = sectors // s
-        if ch > 1024*255: continue
-        for h in (2,4,6,8,9,10,16,32,64,128,240,255): # heads
-            c = ch//h 
-            if c > 1024: continue
-            break
-    # If size exceeds 1024 cylinders, returns maximum Heads and Sectors per Cylinder
-    if not h:
-        s = 63
-        h = 255
-        c = sectors // (h*s)
+    s = 63 # sectors per cylinder
+    ch = sectors // s
+    # first heads count giving no more than 1024 cylinders; if size exceeds
+    # 1024 cylinders, returns maximum Heads and Sectors per Cylinder
+    h = _HEADS[min(bisect.bisect_right(_HEADS_LIMIT, ch), len(_HEADS)-1)]
+    c = ch//h
     if DEBUG&1: log("%d cylinders with %d heads and %d sectors (CxHxSx%d=%d bytes)",c,h,s,sector,c*h*s*sector)
     return c, h, s
 
@@ -164,41 +257,46 @@ def lba2chs(lba, hpc, spc):
     s = (lba%spc)+1
     return c, h, s
 
+_CHS = struct.Struct('<BBB') # raw 24-bit CHS: head, sector (plus cylinder bits 8-9), cylinder
+
 def chs2raw(t):
     "Converts a CHS address from tuple to raw 24-bit MBR format"
     c,h,s = t
     if c > 1023:
-        B1, B2, B3 = 254, 255, 255
-    else:
-        B1, B2, B3 = h, (c&768)>>2|s, c&255
-    #~ print "DEBUG: MBR bytes for LBA %d (%Xh): %02Xh %02Xh %02Xh"%(lba, lba, B1, B2, B3)
-    return b'%c%c%c' % (B1, B2, B3)
+        return b'\xFE\xFF\xFF'
+    return _CHS.pack(h, (c&768)>>2|s, c&255)
 
 def raw2chs(t):
     "Converts a raw 24-bit CHS address into tuple"
-    h,s,c = t[0], t[1], t[2]
+    h,s,c = _CHS.unpack_from(t)
     return ((s  & 192) << 2) | c, h, s & 63
 
+_zeroes = bytes(1<<20) # shared zeroed buffer, grown when needed
+
+def is_zeroed(s, offset=0, size=None):
+    "Tells if 'size' bytes of s from 'offset' are all zero, without copying them"
+    global _zeroes
+    if size is None: size = len(s) - offset
+    if size > len(_zeroes): _zeroes = bytes(size)
+    return _zeroes.startswith(memoryview(s)[offset:offset+size])
+
+def zeroes(size):
+    "Returns a read-only view on 'size' bytes of the shared zeroed buffer"
+    global _zeroes
+    if size > len(_zeroes): _zeroes = bytes(size)
+    return memoryview(_zeroes)[:size]
+
 def roundMB(n):
     "Round n at MiB"
     return  (n+(1<<20)-1) // (1<<20) * (1<<20)
 
 def calc_rel_path(base, child):
     "returns the path of base relative to child"
-    base_parts = re.split(r'[\\/]+', os.path.abspath(base))
-    child_parts = re.split(r'[\\/]+', os.path.abspath(child))
-    # strips common subpath, if any
-    i=0
-    while base_parts[i] == child_parts[i]: i += 1
-    # returns base if they don't share anything
-    if not i: return base
-    n = len(child_parts) - 1 - i # counts path separators
-    if n:
-        relpath = ''
-    else:
-        relpath = '.\\'
-    while n:
-        relpath += '..\\'
-        n -= 1
-    relpath += '\\'.join(base_parts[i:])
+    try:
+        relpath = os.path.relpath(os.path.abspath(base), os.path.dirname(os.path.abspath(child)))
+    except ValueError:
+        return base # they don't share anything (i.e. different drives)
+    relpath = relpath.replace('/', '\\')
+    if not relpath.startswith('..\\'):
+        relpath = '.\\' + relpath
     return relpath
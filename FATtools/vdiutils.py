@@ -25,13 +25,15 @@ not modified after creation of the delta image.
 
 A Fixed VDI is like a Dynamic one, also: but all blocks are allocated at
 creation time."""
-import atexit, io, struct, uuid, zlib, ctypes, time, os, math, glob
+import atexit, io, struct, uuid, zlib, ctypes, time, os, sys, math, glob, array
 
 DEBUG=int(os.getenv('FATTOOLS_DEBUG', '0'))
 import FATtools.utils as utils
 from FATtools.debug import log
 from FATtools.utils import myfile
 
+_U32 = struct.Struct('<I') # BAT entry
+
 
 
 class Header(object):
@@ -72,18 +74,13 @@ class Header(object):
         self._pos = offset # base offset
         self._buf = s or bytearray(512)
         self.stream = stream
-        self._kv = self.layout.copy()
-        self._vk = {} # { name: offset}
-        for k, v in list(self._kv.items()):
-            self._vk[v[0]] = k
+        utils.unpack_runs(self, self._runs) # fields are plain attributes from now on
     
     __getattr__ = utils.common_getattr
 
     def pack(self):
         "Updates internal buffer"
-        for k, v in list(self._kv.items()):
-            self._buf[k:k+struct.calcsize(v[1])] = struct.pack(v[1], getattr(self, v[0]))
-        return self._buf
+        return utils.pack_runs(self, self._runs)
 
     def __str__ (self):
         return utils.class2str(self, "VDI Header @%X\n" % self._pos)
@@ -93,6 +90,8 @@ class Header(object):
             return 0
         return 1
 
+utils.compile_layout(Header)
+
 
 class BAT(object):
     "Implements the Block Address Table as indexable object"
@@ -101,8 +100,14 @@ class BAT(object):
         self.size = blocks # total blocks in the data area
         self.bsize = block_size # block size
         self.offset = offset # relative BAT offset
-        self.decoded = {} # {block index: block effective sector}
+        # [block index] = block effective sector: the whole table, read once
+        stream.seek(offset)
+        raw = stream.read(blocks*4)
+        raw += (blocks*4-len(raw))*b'\xFF' # truncated table: missing entries are unallocated
+        self.decoded = array.array('I', raw)
+        if sys.byteorder == 'big': self.decoded.byteswap()
         self.isvalid = 1 # self test result
+        self._lo, self._hi = blocks, -1 # range of entries changed by update, not yet written
         #~ self._isvalid() # performs self test
 
     def __str__ (self):
@@ -115,15 +120,8 @@ class BAT(object):
         if DEBUG&16: log("%s: requested to read BAT[0x%X]", self.stream.name, index)
         if not (0 <= index <= self.size-1):
             raise BaseException("Attempt to read a #%d block past disk end"%index)
-        slot = self.decoded.get(index)
-        if slot: return slot
-        pos = self.offset + index*4
-        opos = self.stream.tell()
-        self.stream.seek(pos)
-        slot = struct.unpack("<I", self.stream.read(4))[0]
-        self.decoded[index] = slot
-        if DEBUG&16: log("%s: got BAT[0x%X]=0x%X @0x%X", self.stream.name, index, slot, pos)
-        self.stream.seek(opos) # rewinds
+        slot = self.decoded[index]
+        if DEBUG&16: log("%s: got BAT[0x%X]=0x%X @0x%X", self.stream.name, index, slot, self.offset + index*4)
         return slot
 
     def __setitem__ (self, index, value):
@@ -134,11 +132,22 @@ class BAT(object):
         dsp = index*4
         pos = self.offset+dsp
         if DEBUG&16: log("%s: set BAT[0x%X]=0x%X @0x%X", self.stream.name, index, value, pos)
-        opos = self.stream.tell()
-        self.stream.seek(pos)
-        value = struct.pack("<I", value)
-        self.stream.write(value)
-        self.stream.seek(opos) # rewinds
+        self.stream.pwrite(_U32.pack(value), pos)
+
+    def update(self, index, value):
+        "Sets the value stored in a given block index in memory only, until flush"
+        self.decoded[index] = value
+        if index < self._lo: self._lo = index
+        if index > self._hi: self._hi = index
+
+    def flush(self):
+        "Writes the entries changed by update with a single write"
+        if self._hi < self._lo: return
+        run = self.decoded[self._lo:self._hi+1]
+        if sys.byteorder == 'big': run.byteswap()
+        if DEBUG&16: log("%s: flushing BAT[0x%X:0x%X]", self.stream.name, self._lo, self._hi+1)
+        self.stream.pwrite(run, self.offset+self._lo*4)
+        self._lo, self._hi = self.size, -1
         
     def _isvalid(self, selftest=1):
         "Checks BAT for invalid entries setting .isvalid member"
@@ -153,35 +162,52 @@ class BAT(object):
         first_block = last_block%raw_size # theoretical address of first block
         bat_size = utils.roundMB(self.size*4)
         allocated = (ssize-bat_size)//raw_size
-        unallocated = 0
-        seen = []
-        for i in range(self.size):
-            a = self[i]
-            if a == 0xFFFFFFFF or a == 0xFFFFFFFE:
-                unallocated+=1
-                continue
-            if a in seen:
-                self.isvalid = -2 # duplicated block address
-                if DEBUG&16: log("%s: BAT[%d] offset (sector %X) was seen more than once", self, i, a)
-                if selftest: break
-                print("ERROR: BAT[%d] offset (sector %X) was seen more than once" %(i, a))
-            if a*self.bsize > last_block or a*self.bsize+raw_size > ssize:
-                if DEBUG&16: log("%s: block %d offset (sector %X) exceeds allocated file size", self, i, a)
-                self.isvalid = -3 # block address beyond file's end detected
-                if selftest: break
-                print("ERROR: BAT[%d] offset (sector %X) exceeds allocated file size" %(i, a))
-            if (a*self.bsize-first_block)%raw_size:
-                if DEBUG&16: log("%s: BAT[%d] offset (sector %X) is not aligned", self, i, a)
-                self.isvalid = -4 # block address not aligned
-                if selftest: break
-                print("ERROR: BAT[%d] offset (sector %X) is not aligned, overlapping blocks" %(i, a))
-            seen += [a]
+        # whole table checks first: blocks offsets are multiples of raw_size, so
+        # only first_block can misalign them, and the highest one tells the range
+        alloc = [a for a in self.decoded if a < 0xFFFFFFFE] # allocated blocks
+        if len(set(alloc)) == len(alloc) and not (alloc and (max(alloc)*self.bsize > last_block or first_block)):
+            unallocated = self.size - len(alloc)
+            scanned = len(alloc)
+        else:
+            # some entry is bad: scans them in order, to report
+            unallocated, scanned, errors = _scan_bat(self.decoded, self.bsize, ssize, first_block, raw_size, selftest)
+            for i, a, code in errors:
+                self.isvalid = code
+                if DEBUG&16: log("%s: BAT[%d] offset (sector %X) %s", self, i, a, _BAT_ERRORS[code])
+                if not selftest: print("ERROR: BAT[%d] offset (sector %X) %s" % (i, a, _BAT_ERRORS[code]))
         if unallocated + allocated != self.size:
-            if DEBUG&16: log("%s: BAT has %d blocks allocated only, container %d", self, len(seen), allocated)
+            if DEBUG&16: log("%s: BAT has %d blocks allocated only, container %d", self, scanned, allocated)
             self.isvalid = 0
             if selftest: return
-            print("WARNING: BAT has %d blocks allocated only, container %d" % (len(seen), allocated))
-
+            print("WARNING: BAT has %d blocks allocated only, container %d" % (scanned, allocated))
+
+
+_BAT_ERRORS = {-2: "was seen more than once", -3: "exceeds allocated file size", -4: "is not aligned, overlapping blocks"}
+
+def _scan_bat(decoded, bsize, ssize, first_block, raw_size, stop):
+    """Checks BAT entries in order, returning the counts of unallocated and checked allocated
+    ones counts, and a list of (index, entry, error code); if stop, ends at first error"""
+    last_block = ssize - raw_size # theoretical offset of last block
+    unallocated = scanned = 0
+    seen = set()
+    errors = []
+    for i, a in enumerate(decoded):
+        if a == 0xFFFFFFFF or a == 0xFFFFFFFE:
+            unallocated+=1
+            continue
+        if a in seen:
+            errors.append((i, a, -2)) # duplicated block address
+            if stop: break
+        pos = a*bsize
+        if pos > last_block or pos+raw_size > ssize:
+            errors.append((i, a, -3)) # block address beyond file's end detected
+            if stop: break
+        if (pos-first_block)%raw_size:
+            errors.append((i, a, -4)) # block address not aligned
+            if stop: break
+        seen.add(a)
+        scanned += 1
+    return unallocated, scanned, errors
 
 
 class Image(object):
@@ -192,17 +218,20 @@ class Image(object):
         self.size = 0 # size of virtual stream
         self.name = name
         self.stream = myfile(name, mode)
+        if hasattr(os, 'posix_fadvise'):
+            # blocks are big runs: asks the kernel for a wider readahead
+            os.posix_fadvise(self.stream.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
         self._file = self.stream
         self.mode = mode
-        self.stream.seek(0, 2)
-        size = self.stream.tell()
+        self._eof = self.stream.seek(0, 2) # container size, kept while allocating blocks
         self.Parent = None
+        self._cow = None # scratch buffer for blocks copied from parent
+        self._hot_bidx, self._hot_bval = -1, 0 # last block index looked up and its BAT entry
         self.stream.seek(0)
         self.header = Header(self.stream.read(512), 512)
         if not self.header.isvalid():
             raise BaseException("VDI Image Dynamic Header is not valid!")
         self.block = self.header.dwBlockSize
-        self.zero = bytearray(self.block)
         self.bat = BAT(self.stream, self.header.dwBATOffset, self.header.dwTotalBlocks, self.block)
         if self.bat.isvalid < 0:
             error = {-1: "insufficient container size", -2: "duplicated block address", -3: "block past end", -4: "misaligned block"}
@@ -211,11 +240,11 @@ class Image(object):
             parent=''
             for vdi in glob.glob('./*.vdi'):
                 if vdi.lower() == name.lower(): continue
-                parent=vdi
-                o=Image(vdi, "rb")
-                if o.header.sUuidCreate == self.header.sUuidLinkage:
-                    break
-                parent=''
+                # compares the candidate's sUuidCreate only, without opening it as Image
+                with myfile(vdi, 'rb') as f:
+                    if f.pread(16, 0x188) == self.header.sUuidLinkage:
+                        parent=vdi
+                        break
             if os.path.exists(parent):
                 if DEBUG&16: log("Ok, parent image found.")
             if not parent:
@@ -225,6 +254,9 @@ class Image(object):
                 raise BaseException("VDI images not linked, sUuidLinkage!=sUuidCreate")
             if self.Parent.header.sUuidModify != self.header.sUuidParentModify:
                 raise BaseException("VDI Image parent's was altered after snapshot!")
+        self._chain = [self] # this image and its parents, nearest first
+        if self.Parent:
+            self._chain += self.Parent._chain
         self.size = self.header.u64CurrentSize
         self.seek(0)
 
@@ -232,10 +264,9 @@ class Image(object):
     
     def has_block(self, i):
         "Tests if a block is effectively allocated by the image or its parent"
-        if self.bat[i] != 0xFFFFFFFF: # unallocated
-            return True
-        if self.Parent:
-            return self.Parent.has_block(i)
+        for img in self._chain:
+            if img.bat.decoded[i] != 0xFFFFFFFF: # unallocated
+                return True
         return False
 
     def cache_flush(self):
@@ -258,8 +289,8 @@ class Image(object):
         if DEBUG&16: log("%s: final _pos is 0x%X", self.name, self._pos)
         if self._pos >= self.size:
             raise BaseException("%s: can't seek @0x%X past disk end!" % (self.name, self._pos))
-        if self.Parent:
-            self.Parent.seek(self._pos) # propagate seek through a parents chain
+        for img in self._chain[1:]:
+            img._pos = self._pos # propagate seek through a parents chain
 
     def tell(self):
         return self._pos
@@ -284,80 +315,118 @@ class Image(object):
         "Reads (Normal, Differencing image)"
         if size == -1 or self._pos + size > self.size:
             size = self.size - self._pos # reads all
-        buf = bytearray()
+        buf = bytearray(size)
+        self.readinto(buf, zeroed=True) # virtual blocks are already there
+        return buf
+
+    def readinto(self, b, zeroed=False):
+        """Reads into a pre-allocated buffer b (Normal, Differencing image), returning the bytes read;
+        if b is known to be zeroed, virtual blocks are skipped"""
+        mv = memoryview(b).cast('B')
+        size = min(len(mv), self.size - self._pos)
+        bat, bsize, stream = self.bat, self.block, self.stream
+        base = self.header.dwBlocksOffset + self.header.dwBlockExtraSize # block #0 data
+        j=0
         while size:
-            block = self.bat[self._pos//self.block]
-            offset = self._pos%self.block
-            leftbytes = self.block-offset
-            if DEBUG&16: log("%s: reading at block %d, offset 0x%X (vpos=0x%X, epos=0x%X)", self.name, self._pos//self.block, offset, self._pos, self.stream.tell())
-            if leftbytes <= size:
-                got=leftbytes
-                size-=leftbytes
+            i = self._pos//bsize
+            if i == self._hot_bidx: # same block as last time
+                block = self._hot_bval
             else:
-                got=size
-                size=0
+                block = self._hot_bval = bat[i]
+                self._hot_bidx = i
+            offset = self._pos%bsize
+            # extends the span over the next blocks, while they follow on disk (or are alike virtual)
+            step = 0 if block==0xFFFFFFFF or block==0xFFFFFFFE else 1
+            last = block
+            got = bsize-offset
+            while got < size:
+                i += 1
+                if bat[i] != last+step: break
+                last += step
+                got += bsize
+            if got > size:
+                got = size
+            size -= got
+            if DEBUG&16: log("%s: reading 0x%X bytes at block %d, offset 0x%X (vpos=0x%X)", self.name, got, self._pos//bsize, offset, self._pos)
             self._pos += got
-            if block==0xFFFFFFFF or block==0xFFFFFFFE:
+            if not step:
                 if self.Parent and block==0xFFFFFFFF:
                     if DEBUG&16: log("%s: reading %d bytes from parent", self.name, got)
                     self.Parent.seek(self._pos-got)
-                    buf += self.Parent.read(got)
-                else:
+                    self.Parent.readinto(mv[j:j+got], zeroed)
+                elif not zeroed:
                     if DEBUG&16: log("%s: block content is virtual (zeroed)", self.name)
-                    buf+=bytearray(got)
-                continue
+                    for k in range(j, j+got, bsize): # from the shared zero buffer, a block at a time
+                        n = min(bsize, j+got-k)
+                        mv[k:k+n] = utils.zeroes(n)
             else:
-                self.stream.seek(self.header.dwBlocksOffset+block*self.block+self.header.dwBlockExtraSize+offset)
-                buf += self.stream.read(got)
-        return buf
+                stream.preadinto(mv[j:j+got], base+block*bsize+offset)
+            j += got
+        return j
 
     def write(self, s):
         "Writes (Normal, Differencing image)"
         if DEBUG&16: log("%s: write 0x%X bytes from 0x%X", self.name, len(s), self._pos)
         size = len(s)
         if not size: return
+        bat, bsize, stream = self.bat, self.block, self.stream
+        base = self.header.dwBlocksOffset + self.header.dwBlockExtraSize # block #0 data
+        mv = memoryview(s) # slices without copying
+        zeroed = size >= bsize and utils.is_zeroed(s) # i.e. a TRIM: one probe for all blocks
         i=0
-        while size:
-            block = self.bat[self._pos//self.block]
-            offset = self._pos%self.block
-            leftbytes = self.block-offset
-            if leftbytes <= size:
-                put=leftbytes
-                size-=leftbytes
-            else:
-                put=size
-                size=0
-            if block==0xFFFFFFFF or block==0xFFFFFFFE:
-                if block==0xFFFFFFFF and self.Parent and self.Parent.has_block(self._pos//self.block):
-                    # copies block from parent if it has one allocated
-                    self.stream.seek(0, 2)
-                    block = (self.stream.tell()-self.header.dwBlocksOffset)//self.block
-                    self.bat[self._pos//self.block] = block
-                    self.Parent.seek(self._pos//self.block*self.block)
-                    self.stream.write(self.Parent.read(self.block))
-                    if DEBUG&16: log("copied old block #%d @0x%X", self._pos//self.block, (block*self.block)+self.header.dwBlocksOffset)
+        try:
+            while size:
+                bidx = self._pos//bsize
+                if bidx == self._hot_bidx: # same block as last time
+                    block = self._hot_bval
+                else:
+                    block = self._hot_bval = bat[bidx]
+                    self._hot_bidx = bidx
+                offset = self._pos%bsize
+                leftbytes = bsize-offset
+                if leftbytes <= size:
+                    put=leftbytes
+                    size-=leftbytes
                 else:
-                    # we keep a block virtualized until we write zeros
-                    if s[i:i+put] == self.zero[:put]:
-                        if block==0xFFFFFFFF:
-                            self.bat[self._pos//self.block] = 0xFFFFFFFE
-                        i+=put
-                        self._pos+=put
-                        if DEBUG&16: log("block #%d @0x%X is zeroed, virtualizing write", self._pos//self.block, (block*self.block)+self.header.dwBlocksOffset)
-                        continue
+                    put=size
+                    size=0
+                if block==0xFFFFFFFF or block==0xFFFFFFFE:
+                    if block==0xFFFFFFFF and self.Parent and self.Parent.has_block(self._pos//bsize):
+                        # copies block from parent if it has one allocated
+                        block = (self._eof-self.header.dwBlocksOffset)//bsize
+                        if self._cow is None: self._cow = bytearray(bsize)
+                        self.Parent.seek(self._pos//bsize*bsize)
+                        n = self.Parent.readinto(self._cow)
+                        if n < bsize: self._cow[n:] = bytes(bsize-n) # last block, past disk end
+                        stream.pwrite(self._cow, self._eof)
+                        self._eof += bsize
+                        bat.update(self._pos//bsize, block) # referenced once copied
+                        self._hot_bidx = -1
+                        if DEBUG&16: log("copied old block #%d @0x%X", self._pos//bsize, (block*bsize)+self.header.dwBlocksOffset)
                     else:
-                        # allocates a new block at end before writing
-                        self.stream.seek(0, 2)
-                        block = (self.stream.tell()-self.header.dwBlocksOffset)//self.block
-                        self.bat[self._pos//self.block] = block
-                        self.stream.seek(self.block-1, 1)
-                        self.stream.write(b'\x00') # force effective block allocation
-                        if DEBUG&16: log("allocating new block #%d @0x%X", self._pos//self.block, (block*self.block)+self.header.dwBlocksOffset)
-            self.stream.seek(self.header.dwBlocksOffset+block*self.block+self.header.dwBlockExtraSize+offset)
-            if DEBUG&16: log("writing at block %d, offset 0x%X (0x%X), buffer[0x%X:0x%X]", self._pos//self.block, offset, self._pos, i, i+put)
-            self.stream.write(s[i:i+put])
-            i+=put
-            self._pos+=put
+                        # we keep a block virtualized until we write zeros
+                        if zeroed or utils.is_zeroed(s, i, put):
+                            if block==0xFFFFFFFF:
+                                bat.update(self._pos//bsize, 0xFFFFFFFE)
+                                self._hot_bidx = -1
+                            i+=put
+                            self._pos+=put
+                            if DEBUG&16: log("block #%d @0x%X is zeroed, virtualizing write", self._pos//bsize, (block*bsize)+self.header.dwBlocksOffset)
+                            continue
+                        else:
+                            # allocates a new block at end before writing
+                            block = (self._eof-self.header.dwBlocksOffset)//bsize
+                            stream.pwrite(b'\x00', self._eof+bsize-1) # force effective block allocation
+                            self._eof += bsize
+                            bat.update(self._pos//bsize, block) # referenced once allocated
+                            self._hot_bidx = -1
+                            if DEBUG&16: log("allocating new block #%d @0x%X", self._pos//bsize, (block*bsize)+self.header.dwBlocksOffset)
+                if DEBUG&16: log("writing at block %d, offset 0x%X (0x%X), buffer[0x%X:0x%X]", self._pos//bsize, offset, self._pos, i, i+put)
+                stream.pwrite(mv[i:i+put], base+block*bsize+offset)
+                i+=put
+                self._pos+=put
+        finally:
+            bat.flush() # writes BAT changes at once, even if a write failed
 
 
 def _mk_common(name, size, block, overwrite):
@@ -400,14 +469,19 @@ def mk_fixed(name, size, block=(1<<20), overwrite='no', sector=512):
     
     bmpsize = h.dwTotalBlocks*4
     # Makes a consecutive array of DWORDs
-    L = [struct.pack('<I', x) for x in range(h.dwTotalBlocks)]
-    run = bytearray().join(L)
+    run = array.array('I', range(h.dwTotalBlocks))
+    if sys.byteorder == 'big': run.byteswap()
     # initializes BAT, MB aligned
     f.write(run)
     f.write(bytearray(h.dwBlocksOffset-bmpsize))
-    # quickly allocates all blocks
-    f.seek(h.dwTotalBlocks*h.dwBlockSize-1)
-    f.write(b'\x00')
+    # allocates all blocks
+    payload = h.dwTotalBlocks*h.dwBlockSize
+    try:
+        os.posix_fallocate(f.fileno(), h.dwBlocksOffset, payload) # reserves real extents
+    except (AttributeError, OSError):
+        # i.e. Windows or a file system without fallocate support: sparse
+        f.seek(h.dwBlocksOffset+payload-1)
+        f.write(b'\x00')
     f.flush(); f.close()
 
 
@@ -35,13 +35,15 @@ block alredy present in an ancestor requires allocating a new zeroed block
 in the child image.
 
 PLEASE NOTE THAT ALL NUMBERS ARE IN BIG ENDIAN FORMAT! """
-import io, struct, uuid, zlib, ctypes, time, os, math
+import io, struct, uuid, zlib, ctypes, time, os, sys, math, array
 
 DEBUG=int(os.getenv('FATTOOLS_DEBUG', '0'))
 import FATtools.utils as utils
 from FATtools.debug import log
 from FATtools.utils import myfile, calc_rel_path
 
+_U32BE = struct.Struct('>I') # BAT entry, checksum
+_FF64K = 65536*b'\xFF' # empty BAT slots, written a piece at a time
 
 MAX_VHD_SIZE = 2040<<30 # Windows 11 won't mount bigger VHDs
 
@@ -73,18 +75,14 @@ class Footer(object):
         self._pos = offset # base offset
         self._buf = s or bytearray(512)
         self.stream = stream
-        self._kv = self.layout.copy()
-        self._vk = {} # { name: offset}
-        for k, v in list(self._kv.items()):
-            self._vk[v[0]] = k
+        utils.unpack_runs(self, self._runs) # fields are plain attributes from now on
     
     __getattr__ = utils.common_getattr
 
     def pack(self):
         "Updates internal buffer"
         self.dwChecksum = 0
-        for k, v in list(self._kv.items()):
-            self._buf[k:k+struct.calcsize(v[1])] = struct.pack(v[1], getattr(self, v[0]))
+        utils.pack_runs(self, self._runs)
         self._buf[64:68] = mk_crc(self._buf) # updates checksum
         return self._buf
 
@@ -92,19 +90,17 @@ class Footer(object):
         return utils.class2str(self, "VHD Footer @%X\n" % self._pos)
     
     def crc(self):
-        crc = self._buf[64:68]
-        self._buf[64:68] = b'\0\0\0\0'
-        c_crc = mk_crc(self._buf)
-        self._buf[64:68] = crc
-        return c_crc
+        # the checksum field counts as zeroed: its bytes are taken away from the sum
+        return _U32BE.pack(~(sum(self._buf) - sum(self._buf[64:68])) & 0xFFFFFFFF)
 
     def isvalid(self):
         if self.sCookie != b'conectix' or self.dwCreatorHost not in (b'Wi2k',b'Mac'):
             return 0
-        if self.dwChecksum != struct.unpack(">I", self.crc())[0]:
-            if DEBUG&16: log("Footer checksum 0x%X calculated != 0x%X stored", self.dwChecksum, struct.unpack(">I", self.crc())[0])
+        if self.dwChecksum != _U32BE.unpack(self.crc())[0]:
+            if DEBUG&16: log("Footer checksum 0x%X calculated != 0x%X stored", self.dwChecksum, _U32BE.unpack(self.crc())[0])
         return 1
 
+utils.compile_layout(Footer)
 
 
 class DynamicHeader(object):
@@ -130,10 +126,7 @@ class DynamicHeader(object):
         self._pos = offset # base offset
         self._buf = s or bytearray(1024)
         self.stream = stream
-        self._kv = self.layout.copy()
-        self._vk = {} # { name: offset}
-        for k, v in list(self._kv.items()):
-            self._vk[v[0]] = k
+        utils.unpack_runs(self, self._runs) # fields are plain attributes from now on
         self.locators = []
         for i in range(8):
             j = 0x240+i*24
@@ -144,8 +137,7 @@ class DynamicHeader(object):
     def pack(self):
         "Updates internal buffer"
         self.dwChecksum = 0
-        for k, v in list(self._kv.items()):
-            self._buf[k:k+struct.calcsize(v[1])] = struct.pack(v[1], getattr(self, v[0]))
+        utils.pack_runs(self, self._runs)
         for i in range(8):
             j = 0x240+i*24
             self._buf[j:j+24] = self.locators[i].pack()
@@ -156,19 +148,17 @@ class DynamicHeader(object):
         return utils.class2str(self, "VHD Dynamic Header @%X\n" % self._pos)
 
     def crc(self):
-        crc = self._buf[0x24:0x28]
-        self._buf[0x24:0x28] = b'\0\0\0\0'
-        c_crc = mk_crc(self._buf)
-        self._buf[0x24:0x28] = crc
-        return c_crc
+        # the checksum field counts as zeroed: its bytes are taken away from the sum
+        return _U32BE.pack(~(sum(self._buf) - sum(self._buf[0x24:0x28])) & 0xFFFFFFFF)
 
     def isvalid(self):
         if self.sCookie != b'cxsparse':
             return 0
-        if self.dwChecksum != struct.unpack(">I", self.crc())[0]:
-            if DEBUG&16: log("Dynamic Header checksum 0x%X calculated != 0x%X stored", self.dwChecksum, struct.unpack(">I", self.crc())[0])
+        if self.dwChecksum != _U32BE.unpack(self.crc())[0]:
+            if DEBUG&16: log("Dynamic Header checksum 0x%X calculated != 0x%X stored", self.dwChecksum, _U32BE.unpack(self.crc())[0])
         return 1
 
+utils.compile_layout(DynamicHeader)
 
 
 class BAT(object):
@@ -178,7 +168,13 @@ class BAT(object):
         self.size = blocks # total blocks in the data area
         self.bsize = block_size # block size
         self.offset = offset # relative BAT offset
-        self.decoded = {} # {block index: block effective sector}
+        # [block index] = block effective sector: the whole table, read once
+        stream.seek(offset)
+        raw = stream.read(blocks*4)
+        raw += (blocks*4-len(raw))*b'\xFF' # truncated table, see _isvalid
+        self.decoded = array.array('I', raw)
+        if sys.byteorder == 'little': self.decoded.byteswap()
+        self._lo, self._hi = blocks, -1 # range of entries changed by update, not yet written
         self.isvalid = 1 # self test result
         self._isvalid() # performs self test
 
@@ -192,15 +188,8 @@ class BAT(object):
         if DEBUG&16: log("%s: requested to read BAT[0x%X]", self.stream.name, index)
         if not (0 <= index <= self.size-1):
             raise BaseException("Attempt to read a #%d block past disk end"%index)
-        slot = self.decoded.get(index)
-        if slot: return slot
-        pos = self.offset + index*4
-        opos = self.stream.tell()
-        self.stream.seek(pos)
-        slot = struct.unpack(">I", self.stream.read(4))[0]
-        self.decoded[index] = slot
-        if DEBUG&16: log("%s: got BAT[0x%X]=0x%X @0x%X", self.stream.name, index, slot, pos)
-        self.stream.seek(opos) # rewinds
+        slot = self.decoded[index]
+        if DEBUG&16: log("%s: got BAT[0x%X]=0x%X @0x%X", self.stream.name, index, slot, self.offset + index*4)
         return slot
 
     def __setitem__ (self, index, value):
@@ -211,11 +200,22 @@ class BAT(object):
         dsp = index*4
         pos = self.offset+dsp
         if DEBUG&16: log("%s: set BAT[0x%X]=0x%X @0x%X", self.stream.name, index, value, pos)
-        opos = self.stream.tell()
-        self.stream.seek(pos)
-        value = struct.pack(">I", value)
-        self.stream.write(value)
-        self.stream.seek(opos) # rewinds
+        self.stream.pwrite(_U32BE.pack(value), pos) # file pointer stays where it is
+
+    def update(self, index, value):
+        "Sets the value stored in a given block index in memory only, until flush"
+        self.decoded[index] = value
+        if index < self._lo: self._lo = index
+        if index > self._hi: self._hi = index
+
+    def flush(self):
+        "Writes the entries changed by update with a single write"
+        if self._hi < self._lo: return
+        run = self.decoded[self._lo:self._hi+1]
+        if sys.byteorder == 'little': run.byteswap()
+        if DEBUG&16: log("%s: flushing BAT[0x%X:0x%X]", self.stream.name, self._lo, self._hi+1)
+        self.stream.pwrite(run, self.offset+self._lo*4)
+        self._lo, self._hi = self.size, -1
         
     def _isvalid(self, selftest=1):
         "Checks BAT for invalid entries setting .isvalid member"
@@ -229,43 +229,53 @@ class BAT(object):
         last_block = ssize - 512 - raw_size # theoretical offset of last block
         first_block = last_block%raw_size # theoretical address of first block
         allocated = (last_block+raw_size-first_block)//raw_size
-        unallocated = 0
-        seen = []
         # Windows 10 does NOT check padding BAT slots for FFFFFFFF,
         # only used indexes have to be valid (DiscUtils VHDDump does!)
-        for i in range(self.size):
-            a = self[i]
-            if a == 0xFFFFFFFF:
-                unallocated+=1
-                continue
-            if a in seen:
-                self.isvalid = -2 # duplicated block address
-                if DEBUG&16: log("%s: BAT[%d] offset (sector %X) was seen more than once", self, i, a)
-                if selftest: break
-                print("ERROR: BAT[%d] offset (sector %X) was seen more than once" %(i, a))
-            if a*512 > last_block or a*512+raw_size > ssize:
-                if DEBUG&16: log("%s: block %d offset (sector %X) exceeds allocated file size", self, i, a)
-                self.isvalid = -3 # block address beyond file's end detected
-                if selftest: break
-                print("ERROR: BAT[%d] offset (sector %X) exceeds allocated file size" %(i, a))
-            if (a*512-first_block)%raw_size: # it's valid, i.e. when a missing Parent Locator sector get fixed!
-                if DEBUG&16: log("%s: BAT[%d] offset (sector %X) is not aligned", self, i, a)
-                #~ self.isvalid = -4 # block address not aligned
-                #~ if selftest: break
-                print("WARNING: BAT[%d] offset (sector %X) is not aligned, overlapping blocks" %(i, a))
-            if a*512 > last_block or a*512+raw_size > (ssize-512):
-                if DEBUG&16: log("%s: block %d offset (sector %X) overlaps Footer", self, i, a)
-                self.isvalid = -5
-                if selftest: break
-                print("ERROR: BAT[%d] offset (sector %X) overlaps Footer" %(i, a))
-            seen += [a]
+        # whole table checks first: the highest block tells the range
+        alloc = [a for a in self.decoded if a != 0xFFFFFFFF] # allocated blocks
+        if len(set(alloc)) == len(alloc) and not (alloc and max(alloc)*512+raw_size > ssize-512) \
+        and not any((a*512-first_block)%raw_size for a in alloc):
+            unallocated = self.size - len(alloc)
+            scanned = len(alloc)
+        else:
+            # some entry is bad: scans them in order, to report
+            unallocated = 0
+            scanned = 0 # allocated entries, duplicates included
+            seen = set()
+            for i in range(self.size):
+                a = self[i]
+                if a == 0xFFFFFFFF:
+                    unallocated+=1
+                    continue
+                if a in seen:
+                    self.isvalid = -2 # duplicated block address
+                    if DEBUG&16: log("%s: BAT[%d] offset (sector %X) was seen more than once", self, i, a)
+                    if selftest: break
+                    print("ERROR: BAT[%d] offset (sector %X) was seen more than once" %(i, a))
+                if a*512 > last_block or a*512+raw_size > ssize:
+                    if DEBUG&16: log("%s: block %d offset (sector %X) exceeds allocated file size", self, i, a)
+                    self.isvalid = -3 # block address beyond file's end detected
+                    if selftest: break
+                    print("ERROR: BAT[%d] offset (sector %X) exceeds allocated file size" %(i, a))
+                if (a*512-first_block)%raw_size: # it's valid, i.e. when a missing Parent Locator sector get fixed!
+                    if DEBUG&16: log("%s: BAT[%d] offset (sector %X) is not aligned", self, i, a)
+                    #~ self.isvalid = -4 # block address not aligned
+                    #~ if selftest: break
+                    print("WARNING: BAT[%d] offset (sector %X) is not aligned, overlapping blocks" %(i, a))
+                if a*512 > last_block or a*512+raw_size > (ssize-512):
+                    if DEBUG&16: log("%s: block %d offset (sector %X) overlaps Footer", self, i, a)
+                    self.isvalid = -5
+                    if selftest: break
+                    print("ERROR: BAT[%d] offset (sector %X) overlaps Footer" %(i, a))
+                seen.add(a)
+                scanned+=1
 
         # Neither Windows 10 nor VHDDump detects this case
         if unallocated + allocated != self.size:
-            if DEBUG&16: log("%s: BAT has %d blocks allocated only, container %d", self, len(seen), allocated)
+            if DEBUG&16: log("%s: BAT has %d blocks allocated only, container %d", self, scanned, allocated)
             self.isvalid = 0
             if selftest: return
-            print("WARNING: BAT has %d blocks allocated only, container %d" % (len(seen), allocated))
+            print("WARNING: BAT has %d blocks allocated only, container %d" % (scanned, allocated))
 
 
 
@@ -283,22 +293,19 @@ class ParentLocator(object):
         self._i = 0
         self._pos = 0
         self._buf = s
-        self._kv = self.layout.copy()
-        self._vk = {} # { name: offset}
-        for k, v in list(self._kv.items()):
-            self._vk[v[0]] = k
+        utils.unpack_runs(self, self._runs) # fields are plain attributes from now on
     
     __getattr__ = utils.common_getattr
 
     def pack(self):
         "Updates internal buffer"
-        for k, v in list(self._kv.items()):
-            self._buf[k:k+struct.calcsize(v[1])] = struct.pack(v[1], getattr(self, v[0]))
+        utils.pack_runs(self, self._runs)
         return self._buf
 
     def __str__ (self):
         return utils.class2str(self, "Parent Locator @%X\n" % self._pos)
 
+utils.compile_layout(ParentLocator)
 
 
 class BlockBitmap(object):
@@ -307,14 +314,35 @@ class BlockBitmap(object):
         if DEBUG&16: log("inited Bitmap for block #%d", i)
         self.bmp = s
         self.i = i
+        self.dirty = False # changed since loaded or committed
 
     def isset(self, sector):
         "Tests if the bit corresponding to a given sector is set"        
         # CAVE! BIT ORDER IS LSB FIRST!
         return (self.bmp[sector//8] & (128 >> (sector%8))) != 0
     
+    def run(self, sector, count):
+        "Returns how many of 'count' sectors from 'sector' are in the same state"
+        bit = self.isset(sector)
+        fill = (b'\x00', b'\xFF')[bit]
+        n = 1
+        while n < count:
+            pos = (sector+n)//8
+            if not (sector+n)%8 and count-n >= 8:
+                # whole bytes at once
+                whole = (count-n)//8
+                same = whole - len(self.bmp[pos:pos+whole].lstrip(fill))
+                n += same*8
+                if same < whole: break
+                continue
+            if self.isset(sector+n) != bit: break
+            n += 1
+        while n < count and self.isset(sector+n) == bit: # partial byte after a whole bytes run
+            n += 1
+        return n
+
     def set(self, sector, length=1, clear=False):
-        "Sets or clears a bit or bits run"
+        "Sets or clears a bit or bits run, marking the bitmap dirty if it changes"
         pos = sector//8
         rem = sector%8
         if DEBUG&16: log("set(%Xh,%d%s) start @0x%X:%d", sector, length, ('',' (clear)')[clear!=False], pos, rem)
@@ -326,19 +354,18 @@ class BlockBitmap(object):
                 B &= ~(((0xFF<<(8-todo))&0xFF) >> rem)
             else:
                 B |= (((0xFF<<(8-todo))&0xFF) >> rem)
+            if B != self.bmp[pos]: self.dirty = True
             self.bmp[pos] = B
             length -= todo
             if DEBUG&16: log("set byte {0:08b}, left={1}".format(B, length))
             pos+=1
         octets = length//8
-        while octets:
-            i = min(32768, octets)
-            octets -= i
-            if clear:
-                self.bmp[pos:pos+i] = bytearray(i)
-            else:
-                self.bmp[pos:pos+i] = i*b'\xFF'
-            pos+=i
+        if octets:
+            fill = (b'\x00' if clear else b'\xFF')*octets
+            if self.bmp[pos:pos+octets] != fill:
+                self.bmp[pos:pos+octets] = fill
+                self.dirty = True
+            pos+=octets
         rem = length%8
         if rem:
             if DEBUG&16: log("last bits=%d", rem)
@@ -348,6 +375,7 @@ class BlockBitmap(object):
                 B &= ~((0xFF<<(8-rem))&0xFF)
             else:
                 B |= ((0xFF<<(8-rem))&0xFF)
+            if B != self.bmp[pos]: self.dirty = True
             self.bmp[pos] = B
             if DEBUG&16: log("set B={0:08b}".format(B))
 
@@ -381,7 +409,9 @@ class Image(object):
             if not self.header.isvalid():
                 raise BaseException("VHD Image Dynamic Header is not valid!")
             self.block = self.header.dwBlockSize
-            self.zero = bytearray(self.block)
+            self._hot_bidx, self._hot_bval = -1, 0 # last block index looked up and its BAT entry
+            self._bmp = None # last block bitmap loaded
+            self._footer_bytes = None # packed footer, appended at every block allocation
             self.bat = BAT(self.stream, self.header.u64TableOffset, self.header.dwMaxTableEntries, self.block)
             self.bitmap_size = max(512, (self.block//512)//8) # bitmap sectors size
             if self.bat.isvalid < 0:
@@ -416,10 +446,10 @@ class Image(object):
                 #~ raise BaseException("Differencing Image timestamp not matched: parent was modified after link!")
             if self.Parent.footer.sUniqueId != self.header.sParentUniqueId:
                 raise BaseException("Differencing Image parent's UUID not matched!")
-            self.read = self.read1 # assigns special read and write functions
+            self.readinto = self.readinto1 # assigns special read and write functions
             self.write = self.write1
         if self.footer.dwDiskType == 2: # Fixed VHD
-            self.read = self.read0 # assigns special read and write functions
+            self.readinto = self.readinto0 # assigns special read and write functions
             self.write = self.write0
             self.stream.seek(0, 2)
             if self.stream.tell() - 512 != self.footer.u64CurrentSize:
@@ -465,24 +495,38 @@ class Image(object):
             return True
         return False
 
-    def read0(self, size=-1):
-        "Reads (Fixed image)"
-        if size == -1 or self._pos + size > self.size:
-            size = self.size - self._pos # reads all
-        self.stream.seek(self._pos)
-        self._pos += size
-        return self.stream.read(size)
-
     def read(self, size=-1):
-        "Reads (Dynamic, non-Differencing image)"
+        "Reads (any image)"
         if size == -1 or self._pos + size > self.size:
             size = self.size - self._pos # reads all
-        buf = bytearray()
+        buf = bytearray(size)
+        self.readinto(buf, zeroed=True) # virtual blocks are already there
+        return buf
+
+    def readinto0(self, b, zeroed=False):
+        "Reads into a pre-allocated buffer b (Fixed image), returning the bytes read"
+        mv = memoryview(b).cast('B')
+        size = min(len(mv), self.size - self._pos)
+        n = self.stream.preadinto(mv[:size], self._pos)
+        self._pos += size
+        return n
+
+    def readinto(self, b, zeroed=False):
+        """Reads into a pre-allocated buffer b (Dynamic, non-Differencing image), returning the bytes read;
+        if b is known to be zeroed, virtual blocks are skipped"""
+        mv = memoryview(b).cast('B')
+        size = min(len(mv), self.size - self._pos)
+        j=0
         while size:
-            block = self.bat[self._pos//self.block]
+            bidx = self._pos//self.block
+            if bidx == self._hot_bidx: # same block as last time
+                block = self._hot_bval
+            else:
+                block = self._hot_bval = self.bat[bidx]
+                self._hot_bidx = bidx
             offset = self._pos%self.block
             leftbytes = self.block-offset
-            if DEBUG&16: log("reading at block %d, offset 0x%X (vpos=0x%X, epos=0x%X)", self._pos//self.block, offset, self._pos, self.stream.tell())
+            if DEBUG&16: log("reading at block %d, offset 0x%X (vpos=0x%X)", self._pos//self.block, offset, self._pos)
             if leftbytes <= size:
                 got=leftbytes
                 size-=leftbytes
@@ -492,161 +536,211 @@ class Image(object):
             self._pos += got
             if block == 0xFFFFFFFF:
                 if DEBUG&16: log("block content is virtual (zeroed)")
-                buf+=bytearray(got)
-                continue
-            self.stream.seek(block*512+self.bitmap_size+offset) # ignores bitmap sectors
-            buf += self.stream.read(got)
-        return buf
-
-    def read1(self, size=-1):
-        "Reads (Differencing image)"
-        if size == -1 or self._pos + size > self.size:
-            size = self.size - self._pos # reads all
-        buf = bytearray()
-        bmp = None
+                if not zeroed: mv[j:j+got] = utils.zeroes(got)
+            else:
+                self.stream.preadinto(mv[j:j+got], block*512+self.bitmap_size+offset) # ignores bitmap sectors
+            j += got
+        return j
+
+    def readinto1(self, b, zeroed=False):
+        """Reads into a pre-allocated buffer b (Differencing image), returning the bytes read;
+        if b is known to be zeroed, virtual blocks are skipped"""
+        mv = memoryview(b).cast('B')
+        pos = self._pos # hot values as locals, for the sector loop
+        bsize, bmsize, stream = self.block, self.bitmap_size, self.stream
+        size = min(len(mv), self.size - pos)
+        bmp = self._bmp
+        j=0
         while size:
-            batind = self._pos//self.block
-            sector = (self._pos-batind*self.block)//512
-            offset = self._pos%512
-            leftbytes = 512-offset
-            block = self.bat[batind]
-            if DEBUG&16: log("%s: reading %d bytes at block %d, offset 0x%X (vpos=0x%X, epos=0x%X)", self.name, size, batind, offset, self._pos, self.stream.tell())
-            if leftbytes <= size:
-                got=leftbytes
-                size-=leftbytes
+            batind = pos//bsize
+            start = batind*bsize # block virtual offset
+            sector = (pos-start)//512
+            offset = pos%512
+            if batind == self._hot_bidx: # same block as last time
+                block = self._hot_bval
             else:
-                got=size
-                size=0
-            self._pos += got
-            # Acquires Block bitmap once
-            if not bmp or bmp.i != block:
-                if block != 0xFFFFFFFF:
-                    self.stream.seek(block*512)
-                    bmp = BlockBitmap(self.stream.read(self.bitmap_size), block)
-            if block == 0xFFFFFFFF or not bmp.isset(sector):
+                block = self._hot_bval = self.bat[batind]
+                self._hot_bidx = batind
+            got = min(size, start+bsize-pos) # up to block end
+            if block != 0xFFFFFFFF:
+                # Acquires Block bitmap once
+                if not bmp or bmp.i != block:
+                    bmp = self._bmp = BlockBitmap(stream.pread(bmsize, block*512), block)
+                # sectors in the same state of the first one are read at once
+                run = bmp.run(sector, (pos+got-start-1)//512 - sector + 1)
+                got = min(got, start+(sector+run)*512-pos)
+            from_parent = block == 0xFFFFFFFF or not bmp.isset(sector)
+            if from_parent:
+                # the parent run goes on across next blocks, while virtual or starting with unused sectors
+                while got < size and not (pos+got)%bsize:
+                    batind += 1
+                    block = self._hot_bval = self.bat[batind]
+                    self._hot_bidx = batind
+                    more = min(size-got, bsize)
+                    if block != 0xFFFFFFFF:
+                        if not bmp or bmp.i != block:
+                            bmp = self._bmp = BlockBitmap(stream.pread(bmsize, block*512), block)
+                        if bmp.isset(0): break
+                        more = min(more, bmp.run(0, (more-1)//512+1)*512)
+                    got += more
+            if DEBUG&16: log("%s: reading %d bytes at block %d, offset 0x%X (vpos=0x%X)", self.name, got, batind, offset, pos)
+            size -= got
+            pos += got
+            if from_parent:
                 if DEBUG&16: log("reading %d bytes from parent", got)
-                self.Parent.seek(self._pos-got)
-                buf += self.Parent.read(got)
+                self.Parent.seek(pos-got)
+                self.Parent.readinto(mv[j:j+got], zeroed)
             else:
                 if DEBUG&16: log("reading %d bytes", got)
-                self.stream.seek(block*512+self.bitmap_size+sector*512+offset)
-                buf += self.stream.read(got)
-        return buf
+                stream.preadinto(mv[j:j+got], block*512+bmsize+sector*512+offset)
+            j += got
+        self._pos = pos
+        return j
 
     def write0(self, s):
         "Writes (Fixed image)"
         if DEBUG&16: log("%s: write 0x%X bytes from 0x%X", self.name, len(s), self._pos)
         size = len(s)
         if not size: return
-        self.stream.seek(self._pos)
+        self.stream.pwrite(s, self._pos)
         self._pos += size
-        self.stream.write(s)
 
     def write(self, s):
         "Writes (Dynamic, non-Differencing image)"
         if DEBUG&16: log("%s: write 0x%X bytes from 0x%X", self.name, len(s), self._pos)
         size = len(s)
         if not size: return
+        mv = memoryview(s) # slices without copying
         i=0
-        while size:
-            block = self.bat[self._pos//self.block]
-            offset = self._pos%self.block
-            leftbytes = self.block-offset
-            if leftbytes <= size:
-                put=leftbytes
-                size-=leftbytes
-            else:
-                put=size
-                size=0
-            if block == 0xFFFFFFFF:
-                # we keep a block virtualized until we write zeros
-                if s[i:i+put] == self.zero[:put]:
-                    i+=put
-                    self._pos+=put
-                    if DEBUG&16: log("block #%d @0x%X is zeroed, virtualizing write", self._pos//self.block, (block*self.block)+self.header.u64DataOffset)
-                    continue
-                # allocates a new block at end before writing
-                self.stream.seek(-512, 2) # overwrites old footer
-                block = self.stream.tell()//512
-                self.bat[self._pos//self.block] = block
-                if DEBUG&16: log("allocating new block #%d @0x%X", self._pos//self.block, block*512)
-                self.stream.write(self.bitmap_size*b'\xFF')
-                self.stream.seek(self.block, 1)
-                self.stream.write(self.footer.pack())
-            self.stream.seek(block*512+self.bitmap_size+offset) # ignores bitmap sectors
-            if DEBUG&16: log("writing at block %d, offset 0x%X (0x%X), buffer[0x%X:0x%X]", self._pos//self.block, offset, self._pos, i, i+put)
-            self.stream.write(s[i:i+put])
-            i+=put
-            self._pos+=put
+        end = None # end of the blocks allocated here, where the footer goes
+        try:
+            while size:
+                bidx = self._pos//self.block
+                if bidx == self._hot_bidx: # same block as last time
+                    block = self._hot_bval
+                else:
+                    block = self._hot_bval = self.bat[bidx]
+                    self._hot_bidx = bidx
+                offset = self._pos%self.block
+                leftbytes = self.block-offset
+                if leftbytes <= size:
+                    put=leftbytes
+                    size-=leftbytes
+                else:
+                    put=size
+                    size=0
+                if block == 0xFFFFFFFF:
+                    # we keep a block virtualized until we write zeros
+                    if utils.is_zeroed(mv, i, put):
+                        i+=put
+                        self._pos+=put
+                        if DEBUG&16: log("block #%d @0x%X is zeroed, virtualizing write", self._pos//self.block, (block*self.block)+self.header.u64DataOffset)
+                        continue
+                    # allocates a new block at end before writing
+                    if end is None: end = self.stream.seek(-512, 2) # overwrites old footer
+                    block = end//512
+                    end += self.bitmap_size+self.block # the footer goes past it, even if writing it fails
+                    self.bat.update(bidx, block)
+                    self._hot_bval = block
+                    if DEBUG&16: log("allocating new block #%d @0x%X", self._pos//self.block, block*512)
+                    self.stream.pwrite(self.bitmap_size*b'\xFF', block*512)
+                if DEBUG&16: log("writing at block %d, offset 0x%X (0x%X), buffer[0x%X:0x%X]", self._pos//self.block, offset, self._pos, i, i+put)
+                self.stream.pwrite(mv[i:i+put], block*512+self.bitmap_size+offset) # ignores bitmap sectors
+                i+=put
+                self._pos+=put
+        finally:
+            if end is not None: # once, after all the new blocks, even if a write failed
+                self.bat.flush() # writes BAT changes at once
+                self._write_footer(end)
+
+    def _write_footer(self, pos):
+        "Writes the footer at pos, the new container end"
+        if not self._footer_bytes: self._footer_bytes = bytes(self.footer.pack())
+        self.stream.pwrite(self._footer_bytes, pos)
 
     def write1(self, s):
         "Writes (Differencing image)"
         if DEBUG&16: log("%s: write 0x%X bytes from 0x%X", self.name, len(s), self._pos)
         size = len(s)
         if not size: return
+        mv = memoryview(s) # slices without copying
         i=0
+        end = None # end of the blocks allocated here, where the footer goes
         bmp = None
-        while size:
-            block = self.bat[self._pos//self.block]
-            offset = self._pos%self.block
-            leftbytes = self.block-offset
-            if leftbytes <= size:
-                put=leftbytes
-                size-=leftbytes
-            else:
-                put=size
-                size=0
-            if block == 0xFFFFFFFF:
-                # we can keep a block virtual until we write zeros and no parent holds it
-                if not self.has_block(self._pos//self.block) and s[i:i+put] == self.zero[:put]:
-                    i+=put
-                    self._pos+=put
-                    if DEBUG&16: log("block #%d @0x%X is zeroed, virtualizing write", self._pos//self.block, (block*self.block)+self.header.u64TableOffset)
-                    continue
-                # allocates a new block at end before writing
-                self.stream.seek(-512, 2) # overwrites old footer
-                block = self.stream.tell()//512
-                self.bat[self._pos//self.block] = block
-                if DEBUG&16: log("%s: allocating new block #%d @0x%X", self.name, self._pos//self.block, block*512)
-                self.stream.write(bytearray(self.bitmap_size)) # all sectors initially zeroed and unused
-                self.stream.write(bytearray(self.block))
-                # instead of copying partial sectors from parent, we copy the full block
-                #~ self.stream.write(self.bitmap_size*'\xFF')
-                #~ self.Parent.seek((self._pos//self.block)*self.block)
-                #~ self.stream.write(self.Parent.read(self.block))
-                self.stream.write(self.footer.pack())
-            if not bmp or bmp.i != block:
-                if bmp: # commits bitmap
-                    if DEBUG&16: log("%s: flushing bitmap for block #%d before moving", self.name, bmp.i)
-                    self.stream.seek(bmp.i*512)
-                    self.stream.write(bmp.bmp)
-                self.stream.seek(block*512)
-                bmp = BlockBitmap(self.stream.read(self.bitmap_size), block)
-            def copysect(vpos, sec):
-                self.Parent.seek((vpos//512)*512) # src sector offset
-                blk = self.bat[vpos//self.block]
-                offs = sec*512 # dest sector offset
-                if DEBUG&16: log("%s: copying parent sector @0x%X to 0x%X", self.name, self.Parent.tell(), blk*512+self.bitmap_size+offs)
-                self.stream.seek(blk*512+self.bitmap_size+offs)
-                self.stream.write(self.Parent.read(512))
-            start = offset//512
-            if offset%512 and not bmp.isset(start): # if middle sector, copy from parent
-                copysect(self._pos, start)
-                bmp.set(start)
-            stop = (offset+put-1)//512
-            if (offset+put)%512 and not bmp.isset(stop):
-                copysect(self._pos+put-1, stop)
-                bmp.set(stop)
-            bmp.set(start, stop-start+1) # sets the bitmap range corresponding to sectors written to
-            self.stream.seek(block*512+self.bitmap_size+offset)
-            if DEBUG&16: log("%s: writing block #%d:0x%X (vpos=0x%X, epos=0x%X), buffer[0x%X:0x%X]", self.name, self._pos//self.block, offset, self._pos, self.stream.tell(), i, i+put)
-            self.stream.write(s[i:i+put])
-            i+=put
-            self._pos+=put
-        if bmp: # None if virtual writes only!
-            if DEBUG&16: log("%s: flushing bitmap for block #%d at end", self.name, bmp.i)
-            self.stream.seek(bmp.i*512)
-            self.stream.write(bmp.bmp)
+        bsize, bmsize = self.block, self.bitmap_size # hot values as locals, for the sector loop
+        aligned = not (self._pos|size)%512 # whole sectors only, as from file systems
+        def copysect(vpos, sec):
+            self.Parent.seek((vpos//512)*512) # src sector offset
+            blk = self.bat[vpos//bsize]
+            offs = sec*512 # dest sector offset
+            if DEBUG&16: log("%s: copying parent sector @0x%X to 0x%X", self.name, self.Parent.tell(), blk*512+bmsize+offs)
+            self.stream.pwrite(self.Parent.read(512), blk*512+bmsize+offs)
+        try:
+            while size:
+                bidx = self._pos//bsize
+                if bidx == self._hot_bidx: # same block as last time
+                    block = self._hot_bval
+                else:
+                    block = self._hot_bval = self.bat[bidx]
+                    self._hot_bidx = bidx
+                offset = self._pos%bsize
+                leftbytes = bsize-offset
+                if leftbytes <= size:
+                    put=leftbytes
+                    size-=leftbytes
+                else:
+                    put=size
+                    size=0
+                if block == 0xFFFFFFFF:
+                    # we can keep a block virtual until we write zeros and no parent holds it
+                    if not self.has_block(self._pos//bsize) and utils.is_zeroed(mv, i, put):
+                        i+=put
+                        self._pos+=put
+                        if DEBUG&16: log("block #%d @0x%X is zeroed, virtualizing write", self._pos//bsize, (block*bsize)+self.header.u64TableOffset)
+                        continue
+                    # allocates a new block at end before writing
+                    if end is None: end = self.stream.seek(-512, 2) # overwrites old footer
+                    block = end//512
+                    end += bmsize+bsize # the footer goes past it, even if writing it fails
+                    self.bat.update(bidx, block)
+                    self._hot_bval = block
+                    if DEBUG&16: log("%s: allocating new block #%d @0x%X", self.name, self._pos//bsize, block*512)
+                    self.stream.pwrite(bytearray(bmsize+bsize), block*512) # all sectors initially zeroed and unused
+                    # instead of copying partial sectors from parent, we copy the full block
+                    #~ self.stream.write(self.bitmap_size*'\xFF')
+                    #~ self.Parent.seek((self._pos//self.block)*self.block)
+                    #~ self.stream.write(self.Parent.read(self.block))
+                if not bmp or bmp.i != block:
+                    if bmp and bmp.dirty: # commits bitmap
+                        if DEBUG&16: log("%s: flushing bitmap for block #%d before moving", self.name, bmp.i)
+                        self.stream.pwrite(bmp.bmp, bmp.i*512)
+                        bmp.dirty = False
+                    if self._bmp and self._bmp.i == block:
+                        bmp = self._bmp # changes go to the cached bitmap, too
+                    else:
+                        bmp = self._bmp = BlockBitmap(self.stream.pread(bmsize, block*512), block)
+                start = offset//512
+                stop = (offset+put-1)//512
+                if not aligned: # partial sectors at both ends
+                    if offset%512 and not bmp.isset(start): # if middle sector, copy from parent
+                        copysect(self._pos, start)
+                        bmp.set(start)
+                    if (offset+put)%512 and not bmp.isset(stop):
+                        copysect(self._pos+put-1, stop)
+                        bmp.set(stop)
+                bmp.set(start, stop-start+1) # sets the bitmap range corresponding to sectors written to
+                if DEBUG&16: log("%s: writing block #%d:0x%X (vpos=0x%X, epos=0x%X), buffer[0x%X:0x%X]", self.name, self._pos//bsize, offset, self._pos, block*512+bmsize+offset, i, i+put)
+                self.stream.pwrite(mv[i:i+put], block*512+bmsize+offset)
+                i+=put
+                self._pos+=put
+            if bmp and bmp.dirty: # None if virtual writes only, clean if all sectors were in use
+                if DEBUG&16: log("%s: flushing bitmap for block #%d at end", self.name, bmp.i)
+                self.stream.pwrite(bmp.bmp, bmp.i*512)
+                bmp.dirty = False
+        finally:
+            if end is not None: # once, after all the new blocks, even if a write failed
+                self.bat.flush() # writes BAT changes at once
+                self._write_footer(end)
 
     def merge(self):
         """Merges a Differencing VHD with its parent and erase the image on success.
@@ -655,30 +749,33 @@ class Image(object):
         i = 0
         tot_blocks=0
         tot_sectors=0
+        reopened=0
+        sectors = self.bitmap_size*8
         while i < self.bat.size:
             # check block presence
             blkoff = self.bat[i]
             if blkoff == 0xFFFFFFFF:
                 i += 1
                 continue
-            self.Parent.close()
-            self.Parent = Image(self.Parent.name, "r+b") # reopen Parent in RW mode
+            if not reopened:
+                self.Parent.close()
+                self.Parent = Image(self.Parent.name, "r+b") # reopen Parent in RW mode
+                reopened=1
             # load and scan the block bitmap
             j = 0
-            self.stream.seek(blkoff*512)
-            bmp = BlockBitmap(self.stream.read(self.bitmap_size), i)
+            bmp = BlockBitmap(self.stream.pread(self.bitmap_size, blkoff*512), i)
             copied=0
-            while j < self.bitmap_size*8:
+            while j < sectors:
+                run = bmp.run(j, sectors-j) # sectors in the same state
                 if bmp.isset(j):
-                    # read the sector
-                    self.stream.seek(blkoff*512 + self.bitmap_size + j*512)
-                    s = self.stream.read(512)
+                    # read the sectors run
+                    s = self.stream.pread(run*512, blkoff*512 + self.bitmap_size + j*512)
                     # seek absolute position in parent and copy
                     self.Parent.seek(i*self.block + j*512)
                     self.Parent.write(s)
-                    tot_sectors+=1
+                    tot_sectors+=run
                     copied=1
-                j += 1
+                j += run
             if copied: tot_blocks+=1
             i += 1
         if DEBUG&16: log("%s: merged %d sectors in %d blocks",self.name,tot_sectors,tot_blocks)
@@ -715,9 +812,16 @@ def mk_chs(size):
 
 def mk_crc(s):
     "Computates and returns as a string the CRC for some disk structures"
-    crc = 0
-    for b in s: crc += b
-    return struct.pack('>i', ~crc)
+    # one's complement of the plain bytes sum, as VHD specifies
+    return _U32BE.pack(~sum(s) & 0xFFFFFFFF)
+
+def write_empty_bat(f, size):
+    "Writes 'size' bytes of empty (0xFF) BAT slots, without building them all in memory"
+    ff = memoryview(_FF64K)
+    while size:
+        n = min(size, len(ff))
+        f.write(ff[:n])
+        size -= n
 
 
 def mk_fixed(name, size, overwrite='no', sector=512):
@@ -802,7 +906,7 @@ def mk_dynamic(name, size, block=(2<<20), upto=0, overwrite='no', sector=512):
     if upto > size:
         bmpsize = (4*((upto+block-1)//block)+511)//512*512
         if DEBUG&16: log("BAT extended to %d blocks, VHD is resizable up to %.02f MiB", bmpsize//4, float(upto//(1<<20)))
-    f.write(bmpsize*b'\xFF') # initializes BAT
+    write_empty_bat(f, bmpsize) # initializes BAT
     f.write(ft.pack()) # stores footer
     f.flush(); f.close()
 
@@ -831,8 +935,9 @@ def mk_diff(name, base, overwrite='no', sector=512):
     rel_base = calc_rel_path(base, name) # gets the path of base image relative to its child
     if rel_base[0] != '.': rel_base = '.\\'+rel_base
     rel_base = rel_base.encode('utf_16_le')
-    abs_base = os.path.abspath(base).encode('utf_16_le')
-    be_base = os.path.abspath(base).encode('utf_16_be')+b'\0\0'
+    abs_path = os.path.abspath(base) # resolved once, for both encodings
+    abs_base = abs_path.encode('utf_16_le')
+    be_base = abs_path.encode('utf_16_be')+b'\0\0'
     
     ima.header.sParentUniqueId = parent_uuid
     ima.header.dwParentTimeStamp = parent_ts # Windows 11, however, does NOT check stored timestamps (nor effective creation time)!
@@ -868,10 +973,10 @@ def mk_diff(name, base, overwrite='no', sector=512):
         
     f.write(ima.header.pack()) # stores dynamic header
 
-    f.write(bmpsize*b'\xFF') # initializes BAT
+    write_empty_bat(f, bmpsize) # initializes BAT
 
-    f.write(rel_base+b'\0'*(loc[0].dwPlatformDataSpace-len(rel_base))) # stores relative parent locator sector
-    f.write(abs_base+b'\0'*(loc[1].dwPlatformDataSpace-len(abs_base))) # stores absolute parent locator sector
+    f.write(rel_base); f.write(utils.zeroes(loc[0].dwPlatformDataSpace-len(rel_base))) # stores relative parent locator sector
+    f.write(abs_base); f.write(utils.zeroes(loc[1].dwPlatformDataSpace-len(abs_base))) # stores absolute parent locator sector
 
     f.write(ima.footer.pack()) # stores footer
     f.flush(); f.close()
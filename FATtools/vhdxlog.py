@@ -13,19 +13,22 @@ from FATtools.debug import log
 #~ logging.basicConfig(level=logging.DEBUG, filename='vhdxlog.log', filemode='w')
 
 LOG_RECORD = 4096 # default size of Log record
+_U32 = struct.Struct('<I') # checksum
+_DESC_SIG = struct.Struct('<4s28x') # Log descriptor signature
 
 def mk_crc(s):
     "Returns the CRC-32C for bytes 's'"
     crc = crc_update(0xffffffff, s, len(s)) ^ 0xffffffff
-    return struct.pack('<I', crc)
+    return _U32.pack(crc)
 
 def global_crc(self):
     "Pluggable helper class member to get CRC from various VHDX structures"
-    crc = self._buf[4:8]
-    self._buf[4:8] = b'\0\0\0\0'
-    c_crc = mk_crc(self._buf)
-    self._buf[4:8] = crc
-    return c_crc
+    # the checksum field counts as zeroed: CRC is chained over the buffer around it
+    b = memoryview(self._buf)
+    crc = crc_update(0xffffffff, b[:4], 4)
+    crc = crc_update(crc, b'\0\0\0\0', 4)
+    crc = crc_update(crc, b[8:], len(b)-8) ^ 0xffffffff
+    return _U32.pack(crc)
 
 
 class ZeroDescriptor(object):
@@ -43,10 +46,7 @@ class ZeroDescriptor(object):
         self._pos = offset # base offset
         self._buf = s or bytearray(32)
         self.stream = stream
-        self._kv = self.layout.copy()
-        self._vk = {} # { name: offset}
-        for k, v in list(self._kv.items()):
-            self._vk[v[0]] = k
+        utils.unpack_runs(self, self._runs) # fields are plain attributes from now on
     
     def __str__ (self):
         return utils.class2str(self, "VHDX Log Zero Descriptor @%X\n" % self._pos)
@@ -55,13 +55,12 @@ class ZeroDescriptor(object):
 
     def pack(self):
         "Updates internal buffer"
-        for k, v in list(self._kv.items()):
-            self._buf[k:k+struct.calcsize(v[1])] = struct.pack(v[1], getattr(self, v[0]))
+        utils.pack_runs(self, self._runs)
         return self._buf
 
     def raw_sector(self):
-        "Reconstructs and returns raw data sector"
-        return bytearray(self.u64ZeroLength)
+        "Returns None: u64ZeroLength bytes at u64FileOffset are zeroed in place by LogStream.zero_range"
+        return None
 
     def isvalid(self):
         if self.sSignature != b'zero' or self.dwReserved != 0:
@@ -70,6 +69,7 @@ class ZeroDescriptor(object):
             return 0
         return 1
 
+utils.compile_layout(ZeroDescriptor)
 
 class DataDescriptor(object):
     "Log Data descriptor"
@@ -87,28 +87,28 @@ class DataDescriptor(object):
         self._pos = offset # base offset
         self._buf = s or bytearray(32)
         self.stream = stream
-        self._kv = self.layout.copy()
-        self._vk = {} # { name: offset}
-        for k, v in list(self._kv.items()):
-            self._vk[v[0]] = k
+        utils.unpack_runs(self, self._runs) # fields are plain attributes from now on
     
     def __str__ (self):
         return utils.class2str(self, "VHDX Log Data Descriptor @%X\n" % self._pos)
 
     __getattr__ = utils.common_getattr
 
-    def raw_sector(self):
-        "Reconstructs and returns raw data sector"
+    def raw_sector(self, inplace=0):
+        """Reconstructs and returns raw data sector; if inplace, it is rebuilt
+        in the associated sector buffer instead of a clone"""
         if not self.sector: return None
-        s = bytearray(self.sector._buf) # clone sector
+        if inplace:
+            s = self.sector._buf # replaces signature and sequence, already checked
+        else:
+            s = bytearray(self.sector._buf) # clone sector
         s[:8] = self._buf[8:16] # leading...
         s[4092:4096] = self._buf[4:8] # ...and trailing bytes
         return s
 
     def pack(self):
         "Updates internal buffer"
-        for k, v in list(self._kv.items()):
-            self._buf[k:k+struct.calcsize(v[1])] = struct.pack(v[1], getattr(self, v[0]))
+        utils.pack_runs(self, self._runs)
         return self._buf
 
     def isvalid(self):
@@ -116,6 +116,7 @@ class DataDescriptor(object):
             return 0
         return 1
 
+utils.compile_layout(DataDescriptor)
 
 class DataSector(object):
     "Log Data sector"
@@ -129,12 +130,8 @@ class DataSector(object):
     def __init__ (self, s=None, offset=0, stream=None):
         self._i = 0
         self._pos = offset # base offset
-        self._buf = s or bytearray(32)
+        self._buf = s or bytearray(4096)
         self.stream = stream
-        self._kv = self.layout.copy()
-        self._vk = {} # { name: offset}
-        for k, v in list(self._kv.items()):
-            self._vk[v[0]] = k
     
     def __str__ (self):
         return utils.class2str(self, "VHDX Log Data Sector @%X\n" % self._pos)
@@ -143,8 +140,7 @@ class DataSector(object):
 
     def pack(self):
         "Updates internal buffer"
-        for k, v in list(self._kv.items()):
-            self._buf[k:k+struct.calcsize(v[1])] = struct.pack(v[1], getattr(self, v[0]))
+        utils.pack_runs(self, self._runs)
         return self._buf
 
     def isvalid(self):
@@ -152,6 +148,7 @@ class DataSector(object):
             return 0
         return 1
 
+utils.compile_layout(DataSector)
 
 class LogEntryHeader(object):
     "Log Entry header and sequence"
@@ -173,10 +170,7 @@ class LogEntryHeader(object):
         self._pos = offset # base offset
         self._buf = s or bytearray(4096)
         self.stream = stream
-        self._kv = self.layout.copy()
-        self._vk = {} # { name: offset}
-        for k, v in list(self._kv.items()):
-            self._vk[v[0]] = k
+        utils.unpack_runs(self, self._runs) # fields are plain attributes from now on
     
     __getattr__ = utils.common_getattr
 
@@ -185,8 +179,7 @@ class LogEntryHeader(object):
     def pack(self):
         "Updates internal buffer"
         self.dwChecksum = 0
-        for k, v in list(self._kv.items()):
-            self._buf[k:k+struct.calcsize(v[1])] = struct.pack(v[1], getattr(self, v[0]))
+        utils.pack_runs(self, self._runs)
         self._buf[4:8] = mk_crc(self._buf) # updates checksum
         return self._buf
 
@@ -196,11 +189,14 @@ class LogEntryHeader(object):
     def isvalid(self, crc_check=0):
         if self.sSignature != b'loge' or self.dwEntryLength%4096 or self.dwTail%4096:
             return 0
-        if crc_check and self.dwChecksum != struct.unpack("<I", self.crc())[0]:
-            if DEBUG&4: log("VHDX Log Entry checksum 0x%X stored != 0x%X calculated", self.dwChecksum, struct.unpack("<I", self.crc())[0])
-            return 0
+        if crc_check:
+            crc = _U32.unpack(self.crc())[0]
+            if self.dwChecksum != crc:
+                if DEBUG&4: log("VHDX Log Entry checksum 0x%X stored != 0x%X calculated", self.dwChecksum, crc)
+                return 0
         return 1
 
+utils.compile_layout(LogEntryHeader)
 
 class LogStream(object):
     "Initialize the Log stream"
@@ -260,12 +256,15 @@ class LogStream(object):
         seq = -1
         i=0
         loop=-1
+        guid = self.vhdx.header.sLogGuid
+        data = f.pread(self.size, self.offset) # the whole Log, scanned in memory
         
         while i < self.size:
-            f.seek(i+self.offset)
-            h = LogEntryHeader(f.read(LOG_RECORD), i)
+            h = None
+            if data.startswith(b'loge', i): # parses signed records only
+                h = LogEntryHeader(data[i:i+LOG_RECORD], i)
             # Exclude entries formally invalid or not belonging to current Log session
-            if not h.isvalid() or h.sLogGuid != self.vhdx.header.sLogGuid:
+            if not h or not h.isvalid() or h.sLogGuid != guid:
                 if DEBUG&4: log("Invalid Log Entry @%X", i)
                 i+=LOG_RECORD
                 if i >= self.size:
@@ -276,9 +275,17 @@ class LogStream(object):
             if DEBUG&8: log("Parsed Log Entry %s", h)
 
             # Check the full entry
-            h._buf += f.read(h.dwEntryLength-LOG_RECORD)
+            if i+h.dwEntryLength <= len(data):
+                h._buf = data[i:i+h.dwEntryLength]
+            else:
+                h._buf += f.pread(h.dwEntryLength-LOG_RECORD, self.offset+i+LOG_RECORD)
             if not h.isvalid(1):
                 if DEBUG&4: log("Invalid Log Entry, bad CRC")
+                i+=LOG_RECORD
+                if i >= self.size:
+                    i = self.size
+                    loop+=1
+                    if loop > 0: break
                 continue
             
             # If self-pointing entry
@@ -330,28 +337,34 @@ class LogStream(object):
             if DEBUG&4: log("Expanding VHDX container from %d to %d bytes", size, size2)
             self.stream.seek(size2-1)
             self.stream.write(b'\x00')
+        pending = {} # { file offset: sector to write, or None if zeroed }, the last logged wins
         # Parse and validate descriptors in each entry
         for e in self.sequence:
             o = 64
             tot_data = 0
-            for j in range(e.u64DescriptorCount):
-                if e._buf[o:o+4] == b'zero':
+            n = e.u64DescriptorCount
+            if 64 + 32*n > len(e._buf):
+                raise BaseException("Invalid Log Descriptor count: %d" % n)
+            ds_base = ((64 + 32*n + 4095)//LOG_RECORD)*LOG_RECORD # 4K pages occupied by descriptors (typically 1)
+            # signatures of all descriptors, unpacked at once
+            for sig, in _DESC_SIG.iter_unpack(memoryview(e._buf)[64:64+32*n]):
+                if sig == b'zero':
                     d = ZeroDescriptor(e._buf[o:o+32], e._pos+o)
                     if DEBUG&4: log("Found Zero Descriptor @0x%08X", e._pos+o)
                     if not d.isvalid():
                         if DEBUG&4: log("Found invalid Zero Descriptor @0x%08X", e._pos)
-                        raise BaseException("Invalid Zero Descriptor: %s"%e._buf[o:o+4]) # since CRC check passed, exceptions should NEVER occur!
-                elif e._buf[o:o+4] == b'desc':
-                    ds_base = ((64 + 32*e.u64DescriptorCount + 4095)//LOG_RECORD)*LOG_RECORD # 4K pages occupied by descriptors (typically 1)
+                        raise BaseException("Invalid Zero Descriptor: %s"%sig) # since CRC check passed, exceptions should NEVER occur!
+                elif sig == b'desc':
                     d = DataDescriptor(e._buf[o:o+32], e._pos+o)
-                    sec_base = ds_base + j*LOG_RECORD
+                    sec_base = ds_base + tot_data*LOG_RECORD # data sectors follow data descriptors only
+                    tot_data += 1
                     d.sector = DataSector(e._buf[sec_base: sec_base+LOG_RECORD], e._pos+sec_base)
                     if not d.isvalid() or not d.sector.isvalid():
                         if DEBUG&4: log("Found invalid Data Desriptor (Sector) @0x%08X (0x%08X)", d._pos, d.sector._pos)
                         raise BaseException("Invalid Data Descriptor (Sector) @0x%08X (0x%08X)"%(d._pos, d.sector._pos))
                     if DEBUG&4: log("Found Data Descriptor/Sector @0x%08X (0x%08X)", d._pos, d.sector._pos)
                 else:
-                    raise BaseException("Invalid Log Descriptor: %s"%e._buf[o:o+4])
+                    raise BaseException("Invalid Log Descriptor: %s"%sig)
                 if d.u64SequenceNumber != e.u64SequenceNumber:
                     if DEBUG&4: log("Unmatched Sequence Numbers in VHDX Header and Descriptor")
                     raise BaseException("Unmatched Sequence Numbers in VHDX Header and Descriptor")
@@ -361,9 +374,45 @@ class LogStream(object):
                         raise BaseException("Unmatched Sequence Numbers in Descriptor and Sector")
                 e.descriptors += [d]
                 o+=32
-            # Rewrites logged sectors
+            # Collects logged sectors
             for desc in e.descriptors:
                 if DEBUG&4: log("Replaying sector @0x%08X", desc.u64FileOffset)
-                self.stream.seek(desc.u64FileOffset)
-                self.stream.write(desc.raw_sector())
+                if desc.sSignature == b'zero':
+                    self.write_sectors(pending) # keeps Log order against zeroed ranges
+                    self.zero_range(desc.u64FileOffset, desc.u64ZeroLength)
+                    continue
+                s = desc.raw_sector(1) # sectors are replayed once
+                pending[desc.u64FileOffset] = None if utils.is_zeroed(s) else s
+        self.write_sectors(pending)
         return 1
+
+    def write_sectors(self, pending):
+        "Rewrites the collected sectors in file order, adjacent ones with a single write, and empties pending"
+        f = self.stream
+        run = [] # adjacent sectors to write
+        for pos in sorted(pending):
+            s = pending[pos]
+            if s is None:
+                self.zero_range(pos, LOG_RECORD)
+                continue
+            if run and pos != run_pos + len(run)*LOG_RECORD:
+                f.pwrite(b''.join(run), run_pos)
+                run = []
+            if not run: run_pos = pos
+            run += [s]
+        if run:
+            f.pwrite(b''.join(run), run_pos)
+        pending.clear()
+
+    def zero_range(self, pos, length):
+        "Zeroes 'length' bytes at 'pos', writing only the Log records not already zeroed (so holes stay sparse)"
+        f = self.stream
+        step = 1<<20
+        for i in range(0, length, step):
+            n = min(step, length-i)
+            s = f.pread(n, pos+i)
+            if len(s) == n and utils.is_zeroed(s): continue
+            for j in range(0, n, LOG_RECORD):
+                if j+LOG_RECORD > len(s) or not utils.is_zeroed(s, j, LOG_RECORD):
+                    if DEBUG&4: log("Zeroing record @0x%08X", pos+i+j)
+                    f.pwrite(utils.zeroes(LOG_RECORD), pos+i+j)
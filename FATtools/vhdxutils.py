@@ -530,7 +530,7 @@ class BAT(object):
         pos = self.offset + index*8
         opos = self.stream.tell()
         self.stream.seek(pos)
-        slot = struct.unpack("<Q", self.stream.read(8))[0]
+        slot = struct.unpack("<Q", self.stream.read_buf(8))[0]
         self.decoded[index] = slot
         if DEBUG&16: log("%s: got BAT[0x%X]=0x%X @0x%X", self.stream.name, index, slot, pos)
         self.stream.seek(opos) # rewinds
@@ -174,7 +174,7 @@ class BAT(object):
         pos = self.offset + index*4
         opos = self.stream.tell()
         self.stream.seek(pos)
-        slot = struct.unpack("<I", self.stream.read(4))[0]
+        slot = struct.unpack("<I", self.stream.read_buf(4))[0]
         self.decoded[index] = slot
         if DEBUG&16: log("%s: got GT[0x%X]=0x%X @0x%X", self.stream.name, index, slot, pos)
         self.stream.seek(opos) # rewinds